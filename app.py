@@ -4,75 +4,127 @@
 # file LICENSE or https://www.opensource.org/licenses/mit-license.php.
 
 import atexit
+import os
 
 from flask import Flask
 from flask_sslify import SSLify
 
 from auth.authentication import authenticate_request, setup_limiter
 from logger.logs import setup_logger
-from routes.routes import base, checkstatus, sendcommand
-from thread_tracker.tracker import cleanup, schedule_start
+from routes.routes import (
+    base,
+    changes,
+    checkstatus,
+    concurrency,
+    hosts,
+    live,
+    ready,
+    sendcommand,
+)
+from thread_tracker.tracker import cleanup, load_job_records, schedule_start
 from tools.helper import verify_config
+from webhook.webhook import start_webhook_workers, stop_webhook_workers
 
+logger = setup_logger()
 
-# Graceful shutdown hook for Gunicorn
-def on_exit(server):
-    print("Shutting down...")
-    cleanup()
+# Process id the background services were started in
+# Threads don't survive a fork, so every worker process needs its own
+services_pid = None
 
 
-# Register the exit hook with Gunicorn
-def post_fork(server, worker):
-    server.log.info("Adding shutdown hook")
-    worker.init_signal = lambda: None
-    worker.log.info("Adding shutdown hook")
-    worker.wsgi = lambda *args, **kwargs: None
-    worker.log.info("Adding shutdown hook")
-    worker.cfg.worker_exit = on_exit
-    worker.log.info("Adding shutdown hook")
+def start_background_services() -> None:
+    """Start the background threads for this process. Safe to call more than once"""
+    global services_pid
 
+    if services_pid == os.getpid():
+        return
+    services_pid = os.getpid()
 
-app = Flask(__name__)
-sslify = SSLify(app)
-logger = setup_logger()
-app.config.from_pyfile("config/config.py")
+    logger.info(f"Starting background services in process: {services_pid}")
+
+    # Load the commands the previous worker generation left behind, so checkstatus can report on them
+    load_job_records()
+
+    # Start the scheduler
+    schedule_start()
+
+    # Start delivering completion webhooks
+    start_webhook_workers()
+
+    # Register cleanup functions to be called when the application exits
+    # atexit runs them in reverse, so webhooks queued by finishing commands are persisted
+    atexit.register(stop_webhook_workers)
+    atexit.register(cleanup)
+
+
+def create_app() -> Flask:
+    """Build the app without starting any threads, so it can be created in the gunicorn
+    master with --preload and shared with the workers"""
+    app = Flask(__name__)
+    SSLify(app)
+    app.config.from_pyfile("config/config.py")
+
+    # Verify the config file is valid
+    verify_config(app)
+
+    # Setup the api rate limiter
+    limiter = setup_limiter(app, app.config["ENV"] == "production")
 
-# Verify the config file is valid
-verify_config(app)
+    # Make sure the background services run in whichever process serves the request,
+    # in case the server didn't start them after forking
+    app.before_request(start_background_services)
 
+    # Setup Authentication Checks (IP, Api-Keys)
+    app.before_request(authenticate_request)
 
-# Setup the api rate limiter
-limiter = setup_limiter(app, app.config["ENV"] == "production")
+    # Routes
+    # Apply limiter to route functions
+    @app.route("/api/", methods=["GET"])
+    @limiter.limit("10 per minute")  # Limiting to 10 requests per minute
+    def base_route():
+        return base()
 
-# Setup Authentication Checks (IP, Api-Keys)
-app.before_request(authenticate_request)
+    @app.route("/api/sendcommand", methods=["POST"])
+    @limiter.limit("50 per minute")  # Limiting to 50 requests per minute
+    def sendcommand_route():
+        return sendcommand()
 
+    @app.route("/api/checkstatus", methods=["POST"])
+    @limiter.limit("50 per minute")  # Limiting to 50 requests per minute
+    def checkstatus_route():
+        return checkstatus()
 
-# Routes
-# Apply limiter to route functions
-@app.route("/api/", methods=["GET"])
-@limiter.limit("10 per minute")  # Limiting to 10 requests per minute
-def base_route():
-    return base()
+    @app.route("/api/changes", methods=["POST"])
+    @limiter.limit("120 per minute")  # Limiting to 120 requests per minute
+    def changes_route():
+        return changes()
 
+    @app.route("/api/hosts", methods=["POST"])
+    @limiter.limit("50 per minute")  # Limiting to 50 requests per minute
+    def hosts_route():
+        return hosts()
 
-@app.route("/api/sendcommand", methods=["POST"])
-@limiter.limit("50 per minute")  # Limiting to 50 requests per minute
-def sendcommand_route():
-    return sendcommand()
+    @app.route("/api/concurrency", methods=["GET"])
+    @limiter.limit("50 per minute")  # Limiting to 50 requests per minute
+    def concurrency_route():
+        return concurrency()
 
+    # Health checks for the load balancer, these aren't rate limited
+    @app.route("/api/health/live", methods=["GET"])
+    @limiter.exempt
+    def live_route():
+        return live()
 
-@app.route("/api/checkstatus", methods=["POST"])
-@limiter.limit("50 per minute")  # Limiting to 50 requests per minute
-def checkstatus_route():
-    return checkstatus()
+    @app.route("/api/health/ready", methods=["GET"])
+    @limiter.exempt
+    def ready_route():
+        return ready()
 
+    return app
 
-# Start the scheduler
-schedule_start()
 
-# Register cleanup function to be called when the application exits
-atexit.register(cleanup)
+app = create_app()
 
 if __name__ == "__main__":
+    start_background_services()
     app.run(ssl_context=("./keys/host.cert", "./keys/host.key"), debug=True)
@@ -2,7 +2,9 @@
 # Copyright (c) 2024 Influx Technologies Limited
 # Distributed under the MIT software license, see the accompanying
 # file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
 
+from urllib.parse import SplitResult, urlsplit
 
 from flask import Flask, Response, jsonify, request
 from flask_limiter import Limiter
@@ -13,6 +15,12 @@ from logger.logs import setup_logger
 
 logger = setup_logger()
 
+# Paths that don't require authentication
+PUBLIC_PATHS = {"/api/health/live", "/api/health/ready"}
+
+# Port used for a callback url that doesn't give one
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
 
 def get_client_ip():
     # Check if the request came through Cloudflare
@@ -26,8 +34,43 @@ def get_client_ip():
         return request.remote_addr
 
 
+def url_port(url: SplitResult) -> int | None:
+    """Port of the url, using the default port of the scheme if it isn't given"""
+    return url.port or DEFAULT_PORTS.get(url.scheme)
+
+
+def is_callback_url_allowed(callback_url: str, whitelisted_url: str) -> bool:
+    """The scheme, host and port must match exactly and the path must be under the
+    whitelisted path. Comparing the strings by prefix would let
+    https://dash.example.com match https://dash.example.com.attacker.net/"""
+    try:
+        url = urlsplit(callback_url)
+        allowed = urlsplit(whitelisted_url)
+        if (
+            url.scheme != allowed.scheme
+            or url.hostname != allowed.hostname
+            or url_port(url) != url_port(allowed)
+        ):
+            return False
+    except ValueError:
+        # Invalid port
+        return False
+
+    # Dot segments could climb out of the whitelisted path once the receiver normalises it
+    if any(segment in (".", "..") for segment in url.path.split("/")):
+        return False
+
+    # Only match whole path segments, so /hooks doesn't allow /hooks-admin
+    allowed_path = allowed.path.rstrip("/")
+    return url.path == allowed_path or url.path.startswith(f"{allowed_path}/")
+
+
 def authenticate_request() -> Response:
 
+    # Health checks come from the load balancer, which doesn't have an api key
+    if request.path in PUBLIC_PATHS:
+        return
+
     # Get the client's IP address
     client_ip = get_client_ip()
 
@@ -110,6 +153,42 @@ def authenticate_request() -> Response:
                             401,
                         )
 
+            # Get the callback url info from the request and config
+            callback_url = data.get("callback_url")
+            whitelisted_callback_urls = api_key_dict.get(
+                "whitelisted_callback_urls", set()
+            )
+
+            if callback_url is not None and not isinstance(callback_url, str):
+                return jsonify({"error": "callback_url must be a string"}), 400
+
+            # If callback url was provided in request
+            if callback_url:
+                if not whitelisted_callback_urls:
+                    logger.info(
+                        f"Request Denied: Unauthorized Callback url: whitelist empty {client_ip}"
+                    )
+                    return (
+                        jsonify({"error": "Unauthorized callback url, whitelist empty"}),
+                        401,
+                    )
+
+                if not any(
+                    is_callback_url_allowed(callback_url, whitelisted_url)
+                    for whitelisted_url in whitelisted_callback_urls
+                ):
+                    logger.info(
+                        f"Request Denied: Unauthorized Callback url: url not in whitelist {client_ip}"
+                    )
+                    return (
+                        jsonify(
+                            {
+                                "error": "Unauthorized callback url, url not in whitelist"
+                            }
+                        ),
+                        401,
+                    )
+
 
 def setup_limiter(theapp: Flask, is_prod: bool) -> Limiter:
     memory_location = "memory://"
@@ -35,6 +35,11 @@ API_KEYS = {
         "whitelisted_ipaddress": "ip-address-here",
         "whitelisted_tags": {"ipcheck"},
         "whitelisted_patterns": {"nickname"},
+        # Optional: urls this key can ask to be called back on when a command completes
+        # The scheme, host and port must match exactly, and the path must be under the whitelisted path
+        "whitelisted_callback_urls": {"https://dashboard.example.com/hooks/"},
+        # Required with whitelisted_callback_urls: secret used to sign the callback payload
+        "callback_secret": "callback-secret-here",
     },
 }
 
@@ -45,3 +50,90 @@ ALLOWED_TAGS = ["ipcheck"]
 # Called using the -l parameters with ansible-playbook
 # nickname ansible_host=0.0.0.0 user=userset n=t0
 ALLOWED_PATTERNS = ["nickname"]
+
+# Maximum number of ansible-playbook commands running at the same time
+# Commands sent while at the limit are queued until a running command completes
+# Set to 0 for no limit
+MAX_RUNNING_PLAYBOOKS = 0
+
+# Adapt the limit to how the host is coping, between ADAPTIVE_MIN_PLAYBOOKS and MAX_RUNNING_PLAYBOOKS
+# The limit goes up by one while commands are waiting and the host is healthy,
+# and down by a quarter when commands slow down or the host is short on cpu or memory
+ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_MIN_PLAYBOOKS = 1
+
+# A command taking longer than this multiple of its usual duration means the host is overloaded
+ADAPTIVE_LATENCY_TOLERANCE = 1.5
+
+# 1 minute load average per cpu above which the host is overloaded
+ADAPTIVE_MAX_LOAD = 1.0
+
+# Fraction of available memory below which the host is overloaded
+ADAPTIVE_MIN_MEMORY = 0.1
+
+# How queued commands are picked when a slot frees up
+# "fifo" - in the order they were sent
+# "shortest" - shortest expected duration first, based on the duration history
+SCHEDULING_POLICY = "shortest"
+
+# Seconds a queued command can wait before it is started ahead of shorter commands
+SHORTEST_JOB_MAX_WAIT = 600
+
+# File used to persist how long each playbook/tag/pattern combination takes to run
+DURATION_HISTORY_FILE = "./duration_history.json"
+
+# Backend used to run ansible-playbook
+# "ansible_runner" - ansible-runner under a pseudo-terminal
+# "subprocess" - direct subprocess with pipes, lower per command overhead
+# "fake" - doesn't run anything, only for testing, rejected when ENV is "production"
+DEFAULT_EXECUTOR = "ansible_runner"
+
+# Override the executor for specific playbooks by keyword ("default" for the default playbook)
+PLAYBOOK_EXECUTORS = {
+    "ssh_setup": "subprocess",
+}
+
+# Completion webhooks
+# Number of threads delivering webhooks at the same time
+WEBHOOK_WORKERS = 4
+
+# Seconds to wait for a webhook receiver to respond
+WEBHOOK_TIMEOUT = 10
+
+# Failed deliveries are retried with exponential backoff, starting at WEBHOOK_RETRY_BASE seconds
+# and capped at WEBHOOK_RETRY_MAX seconds, up to WEBHOOK_MAX_ATTEMPTS attempts in total
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_BASE = 2
+WEBHOOK_RETRY_MAX = 300
+
+# File used to persist webhooks that haven't been delivered yet
+# Each worker writes its own "<file>.<pid>", deliveries left by exited workers are picked up by the others
+WEBHOOK_QUEUE_FILE = "./webhook_queue.json"
+
+# Draining
+# Seconds a stopping worker waits for running commands to complete
+# Commands still running after this are recorded as interrupted
+DRAIN_TIMEOUT = 1800
+
+# While this file exists every worker reports not ready and rejects new commands with a 503
+# Create it at the start of a deploy, and remove it once the new workers are up
+DRAIN_FILE = "./drain"
+
+# File used to pass job records from a stopping worker to the next worker generation
+JOB_RECORDS_FILE = "./job_records.json"
+
+# Change feed
+# Number of job state changes kept for /api/changes
+CHANGE_FEED_SIZE = 10000
+
+# Longest a /api/changes request can wait for a new change, in seconds
+# Each waiting request holds a gunicorn worker thread, so long-polling needs the gthread worker
+# (--threads). Keep this well below gunicorn's timeout
+CHANGE_FEED_MAX_WAIT = 20
+
+# Most /api/changes requests that can wait at once, others are answered straight away
+# Keep this well below the gunicorn threads, so waiting requests can't starve the other endpoints
+CHANGE_FEED_MAX_WAITERS = 2
+
+# SQLite file storing the latest result of each host and tag, served by /api/hosts
+HOST_INDEX_FILE = "./host_index.sqlite3"
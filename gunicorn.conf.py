@@ -0,0 +1,57 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+# Gunicorn loads this file automatically when started from the repository root
+
+import gc
+
+from config.config import DRAIN_TIMEOUT
+
+# Commands, inventory reservations and the concurrency limit are kept in memory in each
+# worker process, so more than one worker would let two commands run on the same inventory
+# and multiply MAX_RUNNING_PLAYBOOKS. Run a single worker and scale it with threads
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+# Give a stopping worker long enough to drain before gunicorn kills it
+graceful_timeout = DRAIN_TIMEOUT + 10
+
+# Gunicorn kills a worker that hasn't sent a heartbeat for this many seconds, including
+# a worker that is draining. The drain keeps sending heartbeats while it waits for
+# running commands (see post_fork), so this can stay short
+timeout = 30
+
+
+# With --preload the app is created once in the master and shared with the workers.
+# Move everything allocated so far out of the garbage collector's reach, so collections in
+# the workers don't write to those pages and break copy-on-write sharing
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+# Threads don't survive a fork, start the background services in each worker.
+# Then drain once the worker has stopped serving requests: running commands get until
+# DRAIN_TIMEOUT to complete, and the job records are saved for the next worker generation.
+# This can't wait for worker_exit, gunicorn has closed the heartbeat file by then
+def post_fork(server, worker):
+    from app import start_background_services
+
+    start_background_services()
+
+    run = worker.run
+
+    def run_and_drain():
+        from thread_tracker.tracker import cleanup
+        from webhook.webhook import stop_webhook_workers
+
+        try:
+            run()
+        finally:
+            worker.log.info("Draining worker")
+            cleanup(heartbeat=worker.notify)
+            stop_webhook_workers()
+
+    worker.run = run_and_drain
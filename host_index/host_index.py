@@ -0,0 +1,228 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+from threading import Lock
+
+from config.config import HOST_INDEX_FILE
+from logger.logs import setup_logger
+
+logger = setup_logger()
+
+# Host status values, from worst to best
+HOST_UNREACHABLE = "unreachable"
+HOST_FAILED = "failed"
+HOST_CHANGED = "changed"
+HOST_OK = "ok"
+
+# Strips terminal colours, ansible-runner runs ansible under a pseudo-terminal
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+# A host line in the PLAY RECAP at the end of the ansible-playbook output
+# nickname : ok=3    changed=1    unreachable=0    failed=0    skipped=2 ...
+RECAP_LINE = re.compile(
+    r"^(?P<host>\S+)\s*:\s*ok=(?P<ok>\d+)\s+changed=(?P<changed>\d+)"
+    r"\s+unreachable=(?P<unreachable>\d+)\s+failed=(?P<failed>\d+)"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS host_results (
+    host TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    status TEXT NOT NULL,
+    changed INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    tracker_event_id TEXT NOT NULL,
+    playbook TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    PRIMARY KEY (host, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS host_results_status ON host_results (status, host);
+"""
+
+# Connection for this process, sqlite connections can't be shared across a fork
+connection = None
+connection_pid = None
+connection_lock = Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get this process's connection. Caller must hold connection_lock"""
+    global connection, connection_pid
+
+    if connection is None or connection_pid != os.getpid():
+        connection = sqlite3.connect(
+            HOST_INDEX_FILE, timeout=10, check_same_thread=False
+        )
+        connection.row_factory = sqlite3.Row
+        # WAL lets the other gunicorn workers read while one of them writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        connection_pid = os.getpid()
+
+    return connection
+
+
+def parse_recap(output: str) -> list[dict]:
+    """Get the per host results from the PLAY RECAP of ansible-playbook output"""
+    output = ANSI_ESCAPE.sub("", output)
+
+    recap_start = output.rfind("PLAY RECAP")
+    if recap_start == -1:
+        return []
+
+    results = []
+    for line in output[recap_start:].splitlines()[1:]:
+        if match := RECAP_LINE.match(line.strip()):
+            changed = int(match["changed"])
+            failed = int(match["failed"])
+            unreachable = int(match["unreachable"])
+
+            if unreachable:
+                status = HOST_UNREACHABLE
+            elif failed:
+                status = HOST_FAILED
+            elif changed:
+                status = HOST_CHANGED
+            else:
+                status = HOST_OK
+
+            results.append(
+                {
+                    "host": match["host"],
+                    "status": status,
+                    "changed": changed > 0,
+                    "failed": failed > 0 or unreachable > 0,
+                }
+            )
+
+    return results
+
+
+def index_results(
+    tracker_event_id: str,
+    tag: str,
+    pattern: str,
+    playbook_name: str,
+    output: str,
+    timestamp: float,
+) -> None:
+    """Store the latest result for each host in a completed run"""
+    results = parse_recap(output)
+    if not results:
+        return
+
+    rows = [
+        (
+            result["host"],
+            tag,
+            result["status"],
+            result["changed"],
+            result["failed"],
+            timestamp,
+            tracker_event_id,
+            playbook_name,
+            pattern,
+        )
+        for result in results
+    ]
+
+    try:
+        with connection_lock:
+            db = get_connection()
+            with db:
+                # Only replace a host's result with a newer one, runs can complete out of order
+                db.executemany(
+                    """
+                    INSERT INTO host_results
+                        (host, tag, status, changed, failed, timestamp, tracker_event_id, playbook, pattern)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (host, tag) DO UPDATE SET
+                        status = excluded.status,
+                        changed = excluded.changed,
+                        failed = excluded.failed,
+                        timestamp = excluded.timestamp,
+                        tracker_event_id = excluded.tracker_event_id,
+                        playbook = excluded.playbook,
+                        pattern = excluded.pattern
+                    WHERE excluded.timestamp >= host_results.timestamp
+                    """,
+                    rows,
+                )
+    except sqlite3.Error as e:
+        logger.info(f"Unable to index host results: ID: {tracker_event_id}, Error: {e}")
+        return
+
+    logger.info(f"Indexed {len(rows)} host results: ID: {tracker_event_id}")
+
+
+def query_results(
+    prefix: str = "",
+    status: str | None = None,
+    tags: list[str] | None = None,
+    patterns: list[str] | None = None,
+    limit: int = 1000,
+) -> list[dict] | None:
+    """Latest results for hosts starting with prefix, optionally filtered by status, tags
+    and the pattern of the run. Returns None if the index can't be read"""
+    conditions = []
+    params = []
+
+    # A range on the primary key instead of LIKE, so the lookup uses the index
+    if prefix:
+        conditions.append("host >= ? AND host < ?")
+        params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+
+    if tags is not None:
+        if not tags:
+            return []
+        conditions.append(f"tag IN ({', '.join('?' for _ in tags)})")
+        params.extend(tags)
+
+    if patterns is not None:
+        if not patterns:
+            return []
+        conditions.append(f"pattern IN ({', '.join('?' for _ in patterns)})")
+        params.extend(patterns)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(limit)
+
+    try:
+        with connection_lock:
+            rows = (
+                get_connection()
+                .execute(
+                    f"SELECT * FROM host_results {where} ORDER BY host, tag LIMIT ?",
+                    params,
+                )
+                .fetchall()
+            )
+    except sqlite3.Error as e:
+        logger.info(f"Unable to query host results: {e}")
+        return None
+
+    return [
+        {
+            "host": row["host"],
+            "tag": row["tag"],
+            "status": row["status"],
+            "changed": bool(row["changed"]),
+            "failed": bool(row["failed"]),
+            "timestamp": row["timestamp"],
+            "tracker_event_id": row["tracker_event_id"],
+            "playbook": row["playbook"],
+            "pattern": row["pattern"],
+        }
+        for row in rows
+    ]
@@ -0,0 +1,141 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import os
+import time
+from collections import deque
+from threading import Lock
+
+from config.config import (
+    ADAPTIVE_CONCURRENCY,
+    ADAPTIVE_LATENCY_TOLERANCE,
+    ADAPTIVE_MAX_LOAD,
+    ADAPTIVE_MIN_MEMORY,
+    ADAPTIVE_MIN_PLAYBOOKS,
+    MAX_RUNNING_PLAYBOOKS,
+)
+from logger.logs import setup_logger
+
+logger = setup_logger()
+
+# Multiplier applied to the limit when the host is overloaded
+DECREASE_FACTOR = 0.75
+
+# Number of recent limit changes kept for the api
+MAX_DECISIONS = 50
+
+
+def load_per_cpu() -> float | None:
+    """1 minute load average divided by the number of cpus"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return None
+
+
+def memory_available() -> float | None:
+    """Fraction of memory available, None if it can't be read on this system"""
+    meminfo = {}
+    try:
+        with open("/proc/meminfo", "r") as file:
+            for line in file:
+                name, value = line.split(":", 1)
+                meminfo[name] = int(value.split()[0])
+    except (OSError, ValueError):
+        return None
+
+    if not meminfo.get("MemTotal") or "MemAvailable" not in meminfo:
+        return None
+
+    return meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+
+class AdaptiveLimit:
+    """AIMD limit on the number of running playbooks.
+    The limit grows by one when a job completes normally while the limit is holding jobs back,
+    and shrinks by DECREASE_FACTOR when jobs slow down or the host is short on cpu or memory"""
+
+    def __init__(self, min_limit: int, max_limit: int):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, max_limit // 2)
+        # Jobs started before the last decrease ran under the old limit, they don't count
+        # as overload signals again, otherwise one slow burst would shrink the limit many times
+        self.last_decrease = 0.0
+        self.decisions = deque(maxlen=MAX_DECISIONS)
+        self.lock = Lock()
+
+    def overload_reason(self, latency_ratio: float | None) -> str:
+        if latency_ratio is not None and latency_ratio > ADAPTIVE_LATENCY_TOLERANCE:
+            return f"job took {latency_ratio:.2f}x its expected duration"
+
+        load = load_per_cpu()
+        if load is not None and load > ADAPTIVE_MAX_LOAD:
+            return f"load per cpu {load:.2f}"
+
+        memory = memory_available()
+        if memory is not None and memory < ADAPTIVE_MIN_MEMORY:
+            return f"memory available {memory:.2f}"
+
+        return ""
+
+    def on_job_completed(
+        self, started_timestamp: float, latency_ratio: float | None, saturated: bool
+    ) -> None:
+        """Update the limit after a job completes. saturated is True if the limit
+        was holding jobs back"""
+        with self.lock:
+            old_limit = self.limit
+
+            if reason := self.overload_reason(latency_ratio):
+                if started_timestamp < self.last_decrease:
+                    return
+                self.limit = max(self.min_limit, int(self.limit * DECREASE_FACTOR))
+                self.last_decrease = time.time()
+            elif saturated:
+                self.limit = min(self.max_limit, self.limit + 1)
+                reason = "jobs waiting and host healthy"
+            else:
+                return
+
+            if self.limit == old_limit:
+                return
+
+            self.decisions.append(
+                {
+                    "time": time.time(),
+                    "from": old_limit,
+                    "to": self.limit,
+                    "reason": reason,
+                }
+            )
+
+        logger.info(
+            f"Concurrency limit changed from {old_limit} to {self.limit}: {reason}"
+        )
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "decisions": list(self.decisions),
+            }
+
+
+adaptive_limit = (
+    AdaptiveLimit(ADAPTIVE_MIN_PLAYBOOKS, MAX_RUNNING_PLAYBOOKS)
+    if ADAPTIVE_CONCURRENCY
+    else None
+)
+
+
+def concurrency_limit() -> int:
+    """Current limit on running playbooks, 0 for no limit"""
+    if adaptive_limit:
+        return adaptive_limit.limit
+    return MAX_RUNNING_PLAYBOOKS
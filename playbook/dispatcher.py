@@ -0,0 +1,240 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import heapq
+import time
+from threading import Lock, Thread
+
+from config.config import SCHEDULING_POLICY, SHORTEST_JOB_MAX_WAIT
+from logger.logs import setup_logger
+from playbook.concurrency import adaptive_limit, concurrency_limit
+from playbook.playbook import run_playbook
+from thread_tracker.changes import CHANGE_QUEUED, CHANGE_STARTED, record_change
+from thread_tracker.history import expected_duration
+from thread_tracker.tracker import (
+    STATUS_RUNNING,
+    Command,
+    draining,
+    event_tracker,
+    threads,
+)
+
+logger = setup_logger()
+
+# Tracker ids waiting for a free slot, in the order they were submitted
+pending_jobs: list[str] = []
+
+# Tracker ids with an ansible-playbook currently running
+running_jobs: set[str] = set()
+
+# Expected duration of each running job when it was started, to measure how much it slowed down
+running_expected: dict[str, float | None] = {}
+
+dispatch_lock = Lock()
+
+
+def has_capacity(running_count: int) -> bool:
+    limit = concurrency_limit()
+    return limit <= 0 or running_count < limit
+
+
+def expected_job_duration(command: Command) -> float | None:
+    return expected_duration(command.playbook_name, command.tag, command.pattern)
+
+
+def expected_job_durations(tracker_event_ids: list[str]) -> dict[str, float | None]:
+    """Expected duration of each job, jobs that no longer exist count as never seen"""
+    expected = {}
+    for tracker_event_id in tracker_event_ids:
+        command = event_tracker.get(tracker_event_id, None)
+        expected[tracker_event_id] = expected_job_duration(command) if command else None
+
+    return expected
+
+
+def next_pending_job(
+    pending: list[str], expected: dict[str, float | None], now: float
+) -> str:
+    """Pick which pending job should start next"""
+    oldest = pending[0]
+    if SCHEDULING_POLICY != "shortest":
+        return oldest
+
+    # A job that has waited too long goes next regardless of its size,
+    # so long jobs can't be starved by a steady stream of short ones
+    command = event_tracker.get(oldest, None)
+    if not command or now - command.queued_timestamp > SHORTEST_JOB_MAX_WAIT:
+        return oldest
+
+    # Jobs we have never seen count as short, so we learn their duration quickly.
+    # min() keeps submission order between jobs with the same expected duration
+    return min(pending, key=lambda tracker_event_id: expected[tracker_event_id] or 0)
+
+
+def submit_playbook(tracker_event_id: str) -> None:
+    """Queue a command and start it as soon as there is capacity"""
+    # Record the change under the lock, so it can't be dispatched and reported as
+    # started before it is reported as queued
+    with dispatch_lock:
+        pending_jobs.append(tracker_event_id)
+        if command := event_tracker.get(tracker_event_id, None):
+            record_change(tracker_event_id, CHANGE_QUEUED, command)
+
+    dispatch_jobs()
+
+
+def dispatch_jobs() -> None:
+    """Start pending jobs until we run out of pending jobs or capacity"""
+    # Queued commands aren't started once this worker is draining, they are recorded as
+    # cancelled. The DRAIN_FILE only stops new commands, so the queue keeps moving
+    if draining.is_set():
+        return
+
+    # Look the durations up once per pass and before taking the lock, the lookups can
+    # wait on the duration history while another thread is writing it to disk
+    with dispatch_lock:
+        if not pending_jobs or not has_capacity(len(running_jobs)):
+            return
+        pending = list(pending_jobs)
+    expected = expected_job_durations(pending)
+
+    with dispatch_lock:
+        while pending_jobs and has_capacity(len(running_jobs)):
+            # Jobs submitted since we looked, there are rarely any
+            if missing := [job for job in pending_jobs if job not in expected]:
+                expected.update(expected_job_durations(missing))
+
+            tracker_event_id = next_pending_job(
+                pending_jobs, expected, time.time()
+            )
+            pending_jobs.remove(tracker_event_id)
+
+            command = event_tracker.get(tracker_event_id, None)
+            if not command:
+                continue
+
+            logger.info(
+                f"Dispatching command: Inventory: {command.pattern}, Tag: {command.tag}, ID: {tracker_event_id}"
+            )
+
+            running_jobs.add(tracker_event_id)
+            running_expected[tracker_event_id] = expected[tracker_event_id]
+            command.set_start_time(time.time())
+            command.set_status(STATUS_RUNNING)
+            record_change(tracker_event_id, CHANGE_STARTED, command)
+
+            # Spin up a new thread to execute the Ansible command
+            thread = Thread(target=run_and_dispatch, args=[tracker_event_id])
+            thread.start()
+
+            # Keep track of the thread
+            threads.append(thread)
+
+
+def run_and_dispatch(tracker_event_id: str) -> None:
+    try:
+        run_playbook(tracker_event_id)
+    finally:
+        with dispatch_lock:
+            # The limit is holding jobs back if jobs are waiting or every slot was in use
+            saturated = bool(pending_jobs) or not has_capacity(len(running_jobs))
+            running_jobs.discard(tracker_event_id)
+            expected = running_expected.pop(tracker_event_id, None)
+
+        if adaptive_limit:
+            update_adaptive_limit(tracker_event_id, expected, saturated)
+
+        # A slot has freed up, start the next job if there is one
+        dispatch_jobs()
+
+
+def update_adaptive_limit(
+    tracker_event_id: str, expected: float | None, saturated: bool
+) -> None:
+    command = event_tracker.get(tracker_event_id, None)
+    if not command or not command.tracker_event.is_set():
+        return
+
+    # Failed runs say more about the nodes than about this host, so only successful
+    # runs are compared with their expected duration
+    latency_ratio = None
+    if expected and command.result.rc == 0:
+        duration = command.completed_timestamp - command.started_timestamp
+        latency_ratio = duration / expected
+
+    adaptive_limit.on_job_completed(command.started_timestamp, latency_ratio, saturated)
+
+
+def dispatch_counts() -> tuple[int, int]:
+    """Number of (running, queued) jobs"""
+    with dispatch_lock:
+        response = len(running_jobs), len(pending_jobs)
+
+    return response
+
+
+def is_job_queued(tracker_event_id: str) -> bool:
+    with dispatch_lock:
+        response = tracker_event_id in pending_jobs
+
+    return response
+
+
+def estimate_job_times(tracker_event_id: str) -> tuple[float | None, float | None]:
+    """Estimate the (start, completion) timestamps of a running or queued job.
+    Either value is None if it can't be estimated"""
+    now = time.time()
+
+    with dispatch_lock:
+        running = list(running_jobs)
+        pending = list(pending_jobs)
+
+    command = event_tracker.get(tracker_event_id, None)
+    if not command:
+        return None, None
+
+    if tracker_event_id in running:
+        expected = expected_job_duration(command)
+        if expected is None:
+            return command.started_timestamp, None
+        return command.started_timestamp, command.started_timestamp + expected
+
+    if tracker_event_id not in pending:
+        return None, None
+
+    # Replay the dispatcher: each running job frees its slot when it is expected to finish,
+    # then pending jobs are started in the order the scheduling policy would pick them.
+    # Jobs with unknown durations are assumed to finish straight away
+    slots = []
+    for running_id in running:
+        if running_command := event_tracker.get(running_id, None):
+            expected = expected_job_duration(running_command) or 0
+            slots.append(max(now, running_command.started_timestamp + expected))
+    heapq.heapify(slots)
+
+    expected = {
+        pending_id: expected_job_duration(pending_command)
+        for pending_id in pending
+        if (pending_command := event_tracker.get(pending_id, None))
+    }
+    pending = [pending_id for pending_id in pending if pending_id in expected]
+
+    clock = now
+    while pending:
+        while slots and not has_capacity(len(slots)):
+            clock = max(clock, heapq.heappop(slots))
+
+        next_id = next_pending_job(pending, expected, clock)
+        pending.remove(next_id)
+
+        if next_id == tracker_event_id:
+            if expected[next_id] is None:
+                return clock, None
+            return clock, clock + expected[next_id]
+
+        heapq.heappush(slots, clock + (expected[next_id] or 0))
+
+    return None, None
@@ -0,0 +1,132 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import os
+import selectors
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+
+from config.config import DEFAULT_EXECUTOR, PLAYBOOK_EXECUTORS
+
+# Size of each read from the subprocess pipes
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Executor(ABC):
+    """Runs an executable and returns its (output, error, return code)"""
+
+    name = ""
+
+    @abstractmethod
+    def run(
+        self, executable_cmd: str, cmdline_args: list[str], cwd: str
+    ) -> tuple[str, str, int]:
+        pass
+
+
+class AnsibleRunnerExecutor(Executor):
+    """Runs the command through ansible-runner under a pseudo-terminal"""
+
+    name = "ansible_runner"
+
+    def run(
+        self, executable_cmd: str, cmdline_args: list[str], cwd: str
+    ) -> tuple[str, str, int]:
+        # Imported here so workers that never use this backend don't pay for the import
+        from ansible_runner import run_command
+
+        return run_command(
+            executable_cmd=executable_cmd,
+            host_cwd=cwd,
+            cmdline_args=cmdline_args,
+            # input_fd=sys.stdin,
+            output_fd=sys.stdout,
+            error_fd=sys.stderr,
+        )
+
+
+class SubprocessExecutor(Executor):
+    """Runs the command directly with pipes, waiting on them with a selector
+    instead of polling a pseudo-terminal"""
+
+    name = "subprocess"
+
+    def run(
+        self, executable_cmd: str, cmdline_args: list[str], cwd: str
+    ) -> tuple[str, str, int]:
+        try:
+            process = subprocess.Popen(
+                [executable_cmd, *cmdline_args],
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            return "", str(e), 1
+
+        output = {process.stdout: [], process.stderr: []}
+        echo = {process.stdout: sys.stdout, process.stderr: sys.stderr}
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ)
+            selector.register(process.stderr, selectors.EVENT_READ)
+
+            # Block until one of the pipes has data, so we don't burn cpu while waiting
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, READ_CHUNK_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+
+                    output[key.fileobj].append(chunk)
+                    echo[key.fileobj].write(chunk.decode(errors="replace"))
+
+        rc = process.wait()
+
+        return (
+            b"".join(output[process.stdout]).decode(errors="replace"),
+            b"".join(output[process.stderr]).decode(errors="replace"),
+            rc,
+        )
+
+
+class FakeExecutor(Executor):
+    """Doesn't run anything, returns a canned result. Used for testing"""
+
+    name = "fake"
+
+    def __init__(
+        self, output: str = "", error: str = "", rc: int = 0, duration: float = 0
+    ):
+        self.output = output
+        self.error = error
+        self.rc = rc
+        self.duration = duration
+
+    def run(
+        self, executable_cmd: str, cmdline_args: list[str], cwd: str
+    ) -> tuple[str, str, int]:
+        if self.duration:
+            time.sleep(self.duration)
+
+        return self.output, self.error, self.rc
+
+
+# Available executors by name
+EXECUTORS: dict[str, Executor] = {
+    executor.name: executor
+    for executor in (AnsibleRunnerExecutor(), SubprocessExecutor(), FakeExecutor())
+}
+
+
+def get_executor(playbook_name: str) -> Executor:
+    """Get the executor configured for a playbook, falling back to the default"""
+    return EXECUTORS[PLAYBOOK_EXECUTORS.get(playbook_name, DEFAULT_EXECUTOR)]
@@ -4,15 +4,17 @@
 # file LICENSE or https://www.opensource.org/licenses/mit-license.php.
 
 import os
-import sys
 import time
 import json
 
-from ansible_runner import run_command
-
 from config.config import ALLOWED_TAGS, FLUX_PLAYBOOK_PATH, WORKING_DIR
+from host_index.host_index import index_results
 from logger.logs import setup_logger
+from playbook.executors import get_executor
+from thread_tracker.changes import CHANGE_COMPLETED, record_change
+from thread_tracker.history import record_duration
 from thread_tracker.tracker import (
+    STATUS_COMPLETED,
     EventToTagMap,
     delete_pattern,
     event_tracker,
@@ -20,6 +22,7 @@ from thread_tracker.tracker import (
     pattern_tracker,
     pattern_tracker_lock,
 )
+from webhook.webhook import queue_webhook
 
 logger = setup_logger()
 
@@ -42,7 +45,9 @@ def run_playbook(tracker_event_id: str):
             # This shouldn't happen: but we better double check there wasn't a race condition that
             # allowed pattern to be started while this command was being parsed
             # Even though this shouldn't happen, it is important to have redudency
-            if pattern_tracker.get(command.pattern, None):
+            # The pattern is normally already reserved for this command when it was queued
+            pattern_map = pattern_tracker.get(command.pattern, None)
+            if pattern_map and pattern_map.event_id != tracker_event_id:
                 logger.info(
                     f"Pattern was found running already. Stopping Command: Inventory: {command.pattern}, Tag: {command.tag}, ID: {tracker_event_id}"
                 )
@@ -54,9 +59,11 @@ def run_playbook(tracker_event_id: str):
 
         extra_vars_json = json.dumps(command.extra_vars)
 
-        command.result.output, command.result.error, command.result.rc = run_command(
+        executor = get_executor(command.playbook_name)
+        logger.info(f"Running with executor: {executor.name}, ID: {tracker_event_id}")
+
+        command.result.output, command.result.error, command.result.rc = executor.run(
             executable_cmd="ansible-playbook",
-            host_cwd=WORKING_DIR,
             cmdline_args=[
                 command.playbook_path,
                 "-l",
@@ -66,9 +73,7 @@ def run_playbook(tracker_event_id: str):
                 "--extra-vars",
                 extra_vars_json,
             ],
-            # input_fd=sys.stdin,
-            output_fd=sys.stdout,
-            error_fd=sys.stderr,
+            cwd=WORKING_DIR,
         )
 
         logger.info(
@@ -77,6 +82,27 @@ def run_playbook(tracker_event_id: str):
         logger.info(f"Output: {command.result.output}")
         logger.info(f"Error: {command.result.error}")
 
+        # Keep track of how long this combination took so we can estimate future runs
+        # Only successful runs count, failed or unreachable hosts (ssh timeouts) take
+        # an unrelated amount of time and would skew the estimates
+        if command.result.rc == 0:
+            record_duration(
+                command.playbook_name,
+                command.tag,
+                command.pattern,
+                time.time() - command.started_timestamp,
+            )
+
+        # Keep the latest result for each host, so it can be looked up after the tracker expires
+        index_results(
+            tracker_event_id,
+            command.tag,
+            command.pattern,
+            command.playbook_name,
+            command.result.output,
+            time.time(),
+        )
+
     logger.info(
         f"Setting tracker to completed: Inventory: {command.pattern}, Tag: {command.tag}, ID: {tracker_event_id}",
     )
@@ -85,8 +111,14 @@ def run_playbook(tracker_event_id: str):
     with event_tracker_lock:
         command.tracker_event.set()
         command.set_completed_time(time.time())
+        command.set_status(STATUS_COMPLETED)
+        record_change(tracker_event_id, CHANGE_COMPLETED, command)
 
     # Delete the pattern from pattern tracker once it is completed
     # so we can accept more commands from api for this pattern.
     # This function locks the pattern lock
     delete_pattern(command.pattern)
+
+    # Let the caller know the command completed if they asked for it
+    if command.callback_url:
+        queue_webhook(tracker_event_id, command)
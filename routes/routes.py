@@ -3,28 +3,53 @@
 # Distributed under the MIT software license, see the accompanying
 # file LICENSE or https://www.opensource.org/licenses/mit-license.php.
 
-import threading
 import uuid
+from urllib.parse import urlsplit
 
 from flask import Response, jsonify, request
 
 from config.config import (
+    API_KEYS,
     ALLOWED_PATTERNS,
     ALLOWED_TAGS,
     ALLOWED_PLAYBOOKS,
     ALLOW_DEFAULT_PLAYBOOK,
     DEFAULT_PLAYBOOK,
 )
+from host_index.host_index import (
+    HOST_CHANGED,
+    HOST_FAILED,
+    HOST_OK,
+    HOST_UNREACHABLE,
+    query_results,
+)
 from logger.logs import setup_logger
-from playbook.playbook import run_playbook
+from playbook.concurrency import (
+    adaptive_limit,
+    concurrency_limit,
+    load_per_cpu,
+    memory_available,
+)
+from playbook.dispatcher import (
+    dispatch_counts,
+    estimate_job_times,
+    is_job_queued,
+    submit_playbook,
+)
+from thread_tracker.changes import changes_since, current_feed_id
 from thread_tracker.tracker import (
+    STATUS_CANCELLED,
+    STATUS_INTERRUPTED,
     Command,
+    delete_tracker,
     event_tracker,
     get_pattern_id,
+    is_draining,
     is_pattern_running,
-    threads,
+    load_job_records,
+    reserve_pattern,
 )
-from tools.helper import timestamp_to_datestring
+from tools.helper import api_key_id, optional_datestring, timestamp_to_datestring
 
 # Get the logger so we can log
 logger = setup_logger()
@@ -43,6 +68,11 @@ ANSIBLE_RETURN_CODES = {
     255: "Unknown error, per TQM",
 }
 
+RESTART_MESSAGES = {
+    STATUS_INTERRUPTED: "The api was restarted before the command completed. The command may not have finished.",
+    STATUS_CANCELLED: "The api was restarted before the command started. The command was not run.",
+}
+
 
 # Default call
 def base() -> Response:
@@ -56,8 +86,24 @@ def base() -> Response:
     )
 
 
+# Liveness, the process is up and serving requests
+def live() -> tuple[Response, int]:
+    return jsonify({"status": "alive"}), 200
+
+
+# Readiness, the load balancer should stop sending traffic while we are draining
+def ready() -> tuple[Response, int]:
+    if is_draining():
+        return jsonify({"status": "draining"}), 503
+    return jsonify({"status": "ready"}), 200
+
+
 def sendcommand() -> tuple[Response, int]:
     """Send command function that creates threaded call to ansible-playbook"""
+    # Don't accept new commands while draining, the client should retry on another server
+    if is_draining():
+        return jsonify({"error": "Server is draining, not accepting new commands"}), 503
+
     # Get the required data from the api call
     data = request.get_json()
 
@@ -76,6 +122,7 @@ def sendcommand() -> tuple[Response, int]:
     pattern = data["pattern"]
     tag = data["tag"]
     extra_vars = data.get("extra_vars")
+    callback_url = data.get("callback_url")  # Can be None
 
     # Check to see if this pattern is already running an ansible command
     # If so, we don't want to run another command and screw up the node
@@ -129,6 +176,17 @@ def sendcommand() -> tuple[Response, int]:
     if not isinstance(extra_vars, dict):
         return jsonify({"error": "extra_vars must be a dictionary"}), 400
 
+    # The callback url has already been checked against the api key whitelist
+    # The secret is looked up from the key id when the callback is sent, so every attempt
+    # is signed afresh and the secret is never written to disk
+    callback_key_id = ""
+    if callback_url:
+        url = urlsplit(callback_url)
+        if url.scheme not in ("http", "https") or not url.netloc:
+            return jsonify({"error": "callback_url must be an http or https url"}), 400
+
+        callback_key_id = api_key_id(request.headers.get("X-API-Key"))
+
     # Create the command object
     command = Command(
         pattern=pattern,
@@ -136,6 +194,8 @@ def sendcommand() -> tuple[Response, int]:
         playbook_name=playbook_name,
         playbook_path=playbook_path,
         extra_vars=extra_vars,
+        callback_url=callback_url or "",
+        callback_key_id=callback_key_id,
     )
 
     # Generate a unique identifier for the tracker event
@@ -144,18 +204,30 @@ def sendcommand() -> tuple[Response, int]:
     # Store the event object in the event_tracker dictionary along with its creation time
     event_tracker[tracker_event_id] = command
 
-    # Spin up a new thread to execute the Ansible command
-    thread = threading.Thread(target=run_playbook, args=[tracker_event_id])
-    thread.start()
+    # Claim the pattern now so no other command can be sent to it while this one is queued
+    if not reserve_pattern(pattern, tracker_event_id, tag):
+        delete_tracker(tracker_event_id)
+        return jsonify(
+            {
+                "status": "failed",
+                "message": "Pattern is busy executing another command",
+            }
+        )
+
+    # Queue the command, it is started straight away if there is capacity
+    submit_playbook(tracker_event_id)
 
-    # Keep track of the thread
-    threads.append(thread)
+    queued = is_job_queued(tracker_event_id)
 
     # Return a response indicating that the Ansible command execution has started
     return jsonify(
         {
-            "status": "started",
-            "message": "Ansible command execution started.",
+            "status": "queued" if queued else "started",
+            "message": (
+                "Ansible command queued."
+                if queued
+                else "Ansible command execution started."
+            ),
             "tracker_event_id": tracker_event_id,
             "tag": tag,
             "pattern": pattern,
@@ -178,10 +250,59 @@ def checkstatus() -> tuple[Response, int]:
     # Get the command if we have it
     command = event_tracker.get(tracker_event_id, None)
 
+    # It may belong to a worker that is still draining and has saved it since we last looked
+    if not command:
+        load_job_records()
+        command = event_tracker.get(tracker_event_id, None)
+
     # If we have the command, report our status
     if not command:
         return jsonify({"error": "Tracker event not found"}), 400
 
+    if is_job_queued(tracker_event_id):
+        estimated_start, estimated_completion = estimate_job_times(tracker_event_id)
+        return (
+            jsonify(
+                {
+                    "status": "queued",
+                    "ansible_queued_time": timestamp_to_datestring(
+                        command.queued_timestamp
+                    ),
+                    "estimated_started_time": optional_datestring(estimated_start),
+                    "estimated_completed_time": optional_datestring(
+                        estimated_completion
+                    ),
+                    "tag": command.tag,
+                    "pattern": command.pattern,
+                    "playbook": command.playbook_name,
+                }
+            ),
+            200,
+        )
+
+    # Commands that didn't complete because the api was restarted
+    if command.status in (STATUS_INTERRUPTED, STATUS_CANCELLED):
+        return (
+            jsonify(
+                {
+                    "status": (
+                        "interrupted"
+                        if command.status == STATUS_INTERRUPTED
+                        else "cancelled"
+                    ),
+                    "message": RESTART_MESSAGES.get(command.status),
+                    "ansible_started_time": timestamp_to_datestring(
+                        command.started_timestamp
+                    ),
+                    "tag": command.tag,
+                    "pattern": command.pattern,
+                    "playbook": command.playbook_name,
+                    "result": command.result.output,
+                }
+            ),
+            200,
+        )
+
     if command.tracker_event.is_set():
         rc_message = "default message"
         if command.result.rc in ANSIBLE_RETURN_CODES:
@@ -207,6 +328,7 @@ def checkstatus() -> tuple[Response, int]:
             200,
         )
     else:
+        _, estimated_completion = estimate_job_times(tracker_event_id)
         return (
             jsonify(
                 {
@@ -214,6 +336,9 @@ def checkstatus() -> tuple[Response, int]:
                     "ansible_started_time": timestamp_to_datestring(
                         command.started_timestamp
                     ),
+                    "estimated_completed_time": optional_datestring(
+                        estimated_completion
+                    ),
                     "tag": command.tag,
                     "pattern": command.pattern,
                     "playbook": command.playbook_name,
@@ -221,3 +346,121 @@ def checkstatus() -> tuple[Response, int]:
             ),
             200,
         )
+
+
+# Function to report the concurrency limit and why it last changed
+def concurrency() -> tuple[Response, int]:
+    running, queued = dispatch_counts()
+
+    response = {
+        "adaptive": adaptive_limit is not None,
+        "limit": concurrency_limit(),
+        "running": running,
+        "queued": queued,
+        "load_per_cpu": load_per_cpu(),
+        "memory_available": memory_available(),
+    }
+
+    if adaptive_limit:
+        state = adaptive_limit.to_dict()
+        response["min_limit"] = state["min_limit"]
+        response["max_limit"] = state["max_limit"]
+        response["decisions"] = [
+            {
+                "time": timestamp_to_datestring(decision["time"]),
+                "from": decision["from"],
+                "to": decision["to"],
+                "reason": decision["reason"],
+            }
+            for decision in state["decisions"]
+        ]
+
+    return jsonify(response), 200
+
+
+# Function to fetch the job state changes after a sequence number
+def changes() -> tuple[Response, int]:
+    data = request.get_json()
+    if "since" not in data:
+        return jsonify({"error": "since not provided"}), 400
+
+    since = data["since"]
+    wait = data.get("wait", 0)
+
+    if not isinstance(since, int) or not isinstance(wait, (int, float)):
+        return jsonify({"error": "since and wait must be numbers"}), 400
+
+    feed, latest_sequence, truncated = changes_since(since, wait)
+
+    # Only show jobs for the tags and patterns this api key is allowed to use
+    api_key_dict = API_KEYS.get(request.headers.get("X-API-Key"))
+    whitelisted_tags = api_key_dict.get("whitelisted_tags")
+    whitelisted_patterns = api_key_dict.get("whitelisted_patterns")
+
+    return (
+        jsonify(
+            {
+                "feed_id": current_feed_id(),
+                "latest_sequence": latest_sequence,
+                "truncated": truncated,
+                "changes": [
+                    {
+                        "sequence": change["sequence"],
+                        "tracker_event_id": change["tracker_event_id"],
+                        "state": change["state"],
+                        "time": timestamp_to_datestring(change["time"]),
+                        "tag": change["tag"],
+                        "pattern": change["pattern"],
+                        "playbook": change["playbook"],
+                    }
+                    for change in feed
+                    if ("all" in whitelisted_tags or change["tag"] in whitelisted_tags)
+                    and (
+                        "all" in whitelisted_patterns
+                        or change["pattern"] in whitelisted_patterns
+                    )
+                ],
+            }
+        ),
+        200,
+    )
+
+
+# Function to fetch the latest result of each host
+def hosts() -> tuple[Response, int]:
+    data = request.get_json()
+
+    prefix = data.get("prefix", "")
+    status = data.get("status")  # Can be None
+    tag = data.get("tag")  # Can be None
+    limit = data.get("limit", 1000)
+
+    if not isinstance(prefix, str):
+        return jsonify({"error": "prefix must be a string"}), 400
+
+    if status and status not in (HOST_OK, HOST_CHANGED, HOST_FAILED, HOST_UNREACHABLE):
+        return jsonify({"error": "status not supported"}), 400
+
+    if not isinstance(limit, int) or limit < 1:
+        return jsonify({"error": "limit must be a positive number"}), 400
+
+    # Only show results for the tags and patterns this api key is allowed to use
+    api_key_dict = API_KEYS.get(request.headers.get("X-API-Key"))
+    whitelisted_tags = api_key_dict.get("whitelisted_tags")
+    whitelisted_patterns = api_key_dict.get("whitelisted_patterns")
+
+    tags = None if "all" in whitelisted_tags else list(whitelisted_tags)
+    if tag:
+        # The tag has already been checked against the api key whitelist
+        tags = [tag]
+
+    patterns = None if "all" in whitelisted_patterns else list(whitelisted_patterns)
+
+    results = query_results(prefix, status, tags, patterns, min(limit, 10000))
+    if results is None:
+        return jsonify({"error": "Host index unavailable, try again later"}), 503
+
+    for result in results:
+        result["timestamp"] = timestamp_to_datestring(result["timestamp"])
+
+    return jsonify({"hosts": results}), 200
@@ -0,0 +1,36 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Tests run against config-example.py, with every file written to a temporary directory
+# and ansible-playbook replaced by the fake executor
+TEST_DIR = tempfile.mkdtemp(prefix="fluxansibleapi-tests-")
+
+# The logger writes info.log to the working directory
+os.chdir(TEST_DIR)
+
+config = types.ModuleType("config.config")
+with open(os.path.join(ROOT, "config", "config-example.py")) as file:
+    exec(file.read(), config.__dict__)
+
+config.FLUX_PLAYBOOK_PATH = TEST_DIR
+config.SSHSETUP_PLAYBOOK_PATH = TEST_DIR
+config.WORKING_DIR = TEST_DIR
+config.DEFAULT_EXECUTOR = "fake"
+config.PLAYBOOK_EXECUTORS = {}
+config.DURATION_HISTORY_FILE = os.path.join(TEST_DIR, "duration_history.json")
+config.WEBHOOK_QUEUE_FILE = os.path.join(TEST_DIR, "webhook_queue.json")
+config.DRAIN_FILE = os.path.join(TEST_DIR, "drain")
+config.JOB_RECORDS_FILE = os.path.join(TEST_DIR, "job_records.json")
+config.HOST_INDEX_FILE = os.path.join(TEST_DIR, "host_index.sqlite3")
+
+sys.modules["config.config"] = config
@@ -0,0 +1,56 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import time
+from threading import BoundedSemaphore, Thread
+
+from thread_tracker import changes
+from thread_tracker.tracker import Command
+
+
+def test_feed_id_is_created_per_process():
+    feed_id = changes.current_feed_id()
+    assert changes.current_feed_id() == feed_id
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write, changes.current_feed_id().encode())
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    child_feed_id = os.read(read, 64).decode()
+    os.close(read)
+    os.close(write)
+
+    assert child_feed_id and child_feed_id != feed_id
+
+
+def test_waiters_are_limited(monkeypatch):
+    monkeypatch.setattr(changes, "changes_waiters", BoundedSemaphore(1))
+    sequence = changes.latest_sequence
+
+    waiter = Thread(target=changes.changes_since, args=[sequence, 5])
+    waiter.start()
+    while changes.changes_waiters._value:
+        time.sleep(0.01)
+
+    # The only slot is taken, so this returns without waiting
+    started = time.time()
+    assert changes.changes_since(sequence, 5) == ([], sequence, False)
+    assert time.time() - started < 1
+
+    command = Command(
+        pattern="nickname",
+        tag="ipcheck",
+        playbook_name="flux",
+        playbook_path="flux.yml",
+        extra_vars={},
+    )
+    changes.record_change("waiter", changes.CHANGE_QUEUED, command)
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert changes.changes_waiters._value == 1
@@ -0,0 +1,98 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import time
+
+import pytest
+
+from playbook import concurrency
+from tools.helper import check_config_concurrency
+
+SLOW = concurrency.ADAPTIVE_LATENCY_TOLERANCE + 1
+
+
+class App:
+    def __init__(self, **config):
+        self.config = config
+
+
+@pytest.fixture(autouse=True)
+def healthy_host(monkeypatch):
+    monkeypatch.setattr(concurrency, "load_per_cpu", lambda: None)
+    monkeypatch.setattr(concurrency, "memory_available", lambda: None)
+
+
+def test_increase_only_when_saturated():
+    limit = concurrency.AdaptiveLimit(2, 5)
+    assert limit.limit == 2
+
+    limit.on_job_completed(time.time(), 1.0, saturated=False)
+    assert limit.limit == 2
+
+    for _ in range(10):
+        limit.on_job_completed(time.time(), 1.0, saturated=True)
+    assert limit.limit == 5
+    assert [decision["to"] for decision in limit.decisions] == [3, 4, 5]
+
+
+def test_decrease_clamped_at_min_limit():
+    limit = concurrency.AdaptiveLimit(3, 16)
+    assert limit.limit == 8
+
+    limit.on_job_completed(time.time(), SLOW, saturated=True)
+    assert limit.limit == 6
+
+    for _ in range(5):
+        limit.on_job_completed(time.time(), SLOW, saturated=True)
+    assert limit.limit == 3
+
+
+def test_decrease_on_host_overload(monkeypatch):
+    monkeypatch.setattr(
+        concurrency, "load_per_cpu", lambda: concurrency.ADAPTIVE_MAX_LOAD + 1
+    )
+    limit = concurrency.AdaptiveLimit(1, 16)
+
+    limit.on_job_completed(time.time(), None, saturated=True)
+    assert limit.limit == 6
+    assert limit.decisions[-1]["reason"].startswith("load per cpu")
+
+
+def test_jobs_started_before_a_decrease_are_ignored():
+    limit = concurrency.AdaptiveLimit(1, 16)
+    started = time.time()
+
+    limit.on_job_completed(started, SLOW, saturated=True)
+    assert limit.limit == 6
+
+    # Another job from the same burst ran under the old limit
+    limit.on_job_completed(started, SLOW, saturated=True)
+    assert limit.limit == 6
+
+    # A job started after the cut is a new signal
+    limit.on_job_completed(time.time(), SLOW, saturated=True)
+    assert limit.limit == 4
+
+
+def test_check_config_concurrency():
+    check_config_concurrency(App(ADAPTIVE_CONCURRENCY=False, MAX_RUNNING_PLAYBOOKS=0))
+    check_config_concurrency(
+        App(ADAPTIVE_CONCURRENCY=True, MAX_RUNNING_PLAYBOOKS=4, ADAPTIVE_MIN_PLAYBOOKS=1)
+    )
+
+    with pytest.raises(ValueError, match="MAX_RUNNING_PLAYBOOKS"):
+        check_config_concurrency(
+            App(ADAPTIVE_CONCURRENCY=True, MAX_RUNNING_PLAYBOOKS=0)
+        )
+
+    for min_running in (0, 5):
+        with pytest.raises(ValueError, match="ADAPTIVE_MIN_PLAYBOOKS"):
+            check_config_concurrency(
+                App(
+                    ADAPTIVE_CONCURRENCY=True,
+                    MAX_RUNNING_PLAYBOOKS=4,
+                    ADAPTIVE_MIN_PLAYBOOKS=min_running,
+                )
+            )
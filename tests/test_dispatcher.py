@@ -0,0 +1,185 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import time
+
+import pytest
+
+from playbook import concurrency, dispatcher
+from playbook.executors import EXECUTORS
+from thread_tracker import changes, history, tracker
+
+
+def make_command(tracker_event_id: str, pattern: str, tag: str = "ipcheck"):
+    command = tracker.Command(
+        pattern=pattern,
+        tag=tag,
+        playbook_name="flux",
+        playbook_path="flux.yml",
+        extra_vars={},
+    )
+    tracker.event_tracker[tracker_event_id] = command
+    return command
+
+
+def wait_for(tracker_event_id: str):
+    assert tracker.event_tracker[tracker_event_id].tracker_event.wait(5)
+
+
+@pytest.fixture(autouse=True)
+def reset_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(concurrency, "MAX_RUNNING_PLAYBOOKS", 1)
+    monkeypatch.setattr(dispatcher, "SCHEDULING_POLICY", "shortest")
+    monkeypatch.setattr(dispatcher, "SHORTEST_JOB_MAX_WAIT", 600)
+    monkeypatch.setattr(
+        history, "DURATION_HISTORY_FILE", str(tmp_path / "duration_history.json")
+    )
+    monkeypatch.setattr(history, "duration_history_mtime", None)
+    history.duration_history.clear()
+
+    yield
+
+    for thread in tracker.threads:
+        thread.join(5)
+    tracker.threads.clear()
+    tracker.event_tracker.clear()
+    tracker.pattern_tracker.clear()
+    dispatcher.pending_jobs.clear()
+    dispatcher.running_jobs.clear()
+    dispatcher.running_expected.clear()
+
+
+def test_next_pending_job_fifo(monkeypatch):
+    monkeypatch.setattr(dispatcher, "SCHEDULING_POLICY", "fifo")
+    make_command("long", "a")
+    make_command("short", "b")
+
+    expected = {"long": 600, "short": 5}
+    assert dispatcher.next_pending_job(["long", "short"], expected, time.time()) == "long"
+
+
+def test_next_pending_job_shortest_first():
+    make_command("long", "a")
+    make_command("short", "b")
+    make_command("unknown", "c")
+
+    expected = {"long": 600, "short": 5, "unknown": None}
+    now = time.time()
+
+    # Jobs never seen before count as short
+    pending = ["long", "short", "unknown"]
+    assert dispatcher.next_pending_job(pending, expected, now) == "unknown"
+    assert dispatcher.next_pending_job(["long", "short"], expected, now) == "short"
+
+
+def test_next_pending_job_starvation_guard():
+    long_command = make_command("long", "a")
+    make_command("short", "b")
+    long_command.queued_timestamp = time.time() - 601
+
+    expected = {"long": 600, "short": 5}
+    assert dispatcher.next_pending_job(["long", "short"], expected, time.time()) == "long"
+
+
+def test_estimate_job_times_replays_queue(monkeypatch):
+    durations = {"running": 30, "long": 60, "short": 5}
+    monkeypatch.setattr(
+        dispatcher,
+        "expected_job_duration",
+        lambda command: durations[command.pattern],
+    )
+
+    now = time.time()
+    running = make_command("running", "running")
+    running.started_timestamp = now - 10
+    make_command("long", "long")
+    make_command("short", "short")
+
+    dispatcher.running_jobs.add("running")
+    dispatcher.pending_jobs.extend(["long", "short"])
+
+    started, completed = dispatcher.estimate_job_times("running")
+    assert started == running.started_timestamp
+    assert completed == pytest.approx(now + 20, abs=1)
+
+    # The short job is picked first once the running job frees its slot
+    started, completed = dispatcher.estimate_job_times("short")
+    assert started == pytest.approx(now + 20, abs=1)
+    assert completed == pytest.approx(now + 25, abs=1)
+
+    started, completed = dispatcher.estimate_job_times("long")
+    assert started == pytest.approx(now + 25, abs=1)
+    assert completed == pytest.approx(now + 85, abs=1)
+
+
+def test_submit_queues_at_limit_and_records_duration(monkeypatch):
+    monkeypatch.setattr(EXECUTORS["fake"], "duration", 0.2)
+
+    for tracker_event_id, pattern in (("first", "a"), ("second", "b")):
+        make_command(tracker_event_id, pattern)
+        assert tracker.reserve_pattern(pattern, tracker_event_id, "ipcheck")
+        dispatcher.submit_playbook(tracker_event_id)
+
+    assert not dispatcher.is_job_queued("first")
+    assert dispatcher.is_job_queued("second")
+
+    wait_for("first")
+    wait_for("second")
+
+    first = tracker.event_tracker["first"]
+    second = tracker.event_tracker["second"]
+    assert second.started_timestamp >= first.completed_timestamp
+    assert second.status == tracker.STATUS_COMPLETED
+    assert not tracker.is_pattern_running("b")
+
+    assert history.expected_duration("flux", "ipcheck", "a") == pytest.approx(
+        0.2, abs=0.1
+    )
+
+
+def test_failed_runs_are_not_recorded(monkeypatch):
+    monkeypatch.setattr(EXECUTORS["fake"], "rc", 4)
+
+    make_command("unreachable", "a")
+    tracker.reserve_pattern("a", "unreachable", "ipcheck")
+    dispatcher.submit_playbook("unreachable")
+    wait_for("unreachable")
+
+    assert history.expected_duration("flux", "ipcheck", "a") is None
+
+
+def test_queued_change_is_recorded_before_started():
+    make_command("first", "a")
+    tracker.reserve_pattern("a", "first", "ipcheck")
+    dispatcher.submit_playbook("first")
+    wait_for("first")
+
+    states = [
+        change["state"]
+        for change in changes.changes
+        if change["tracker_event_id"] == "first"
+    ]
+    assert states[:2] == [changes.CHANGE_QUEUED, changes.CHANGE_STARTED]
+
+
+def test_dispatch_looks_up_durations_once_per_pass(monkeypatch):
+    monkeypatch.setattr(concurrency, "MAX_RUNNING_PLAYBOOKS", 0)
+    lookups = []
+    monkeypatch.setattr(
+        dispatcher,
+        "expected_job_duration",
+        lambda command: lookups.append(command.pattern),
+    )
+
+    for tracker_event_id in ("first", "second", "third"):
+        make_command(tracker_event_id, tracker_event_id)
+        tracker.reserve_pattern(tracker_event_id, tracker_event_id, "ipcheck")
+    dispatcher.pending_jobs.extend(["first", "second", "third"])
+
+    dispatcher.dispatch_jobs()
+    for tracker_event_id in ("first", "second", "third"):
+        wait_for(tracker_event_id)
+
+    assert sorted(lookups) == ["first", "second", "third"]
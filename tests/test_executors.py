@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import sys
+
+import pytest
+
+from playbook import executors
+from tools.helper import check_config_executors
+
+# Bigger than a pipe buffer, so the executor must read both pipes while the process runs
+LARGE_OUTPUT = 1024 * 1024
+
+
+class App:
+    def __init__(self, **config):
+        self.config = config
+
+
+def run_python(code: str, tmp_path) -> tuple[str, str, int]:
+    return executors.EXECUTORS["subprocess"].run(
+        sys.executable, ["-c", code], str(tmp_path)
+    )
+
+
+def test_subprocess_returns_rc(tmp_path):
+    assert run_python("import sys; sys.exit(4)", tmp_path) == ("", "", 4)
+
+
+def test_subprocess_captures_large_stdout_and_stderr_separately(tmp_path):
+    output, error, rc = run_python(
+        "import sys\n"
+        f"sys.stderr.write('e' * {LARGE_OUTPUT})\n"
+        f"sys.stdout.write('o' * {LARGE_OUTPUT})\n",
+        tmp_path,
+    )
+
+    assert rc == 0
+    assert output == "o" * LARGE_OUTPUT
+    assert error == "e" * LARGE_OUTPUT
+
+
+def test_subprocess_reports_os_errors(tmp_path):
+    output, error, rc = executors.EXECUTORS["subprocess"].run(
+        str(tmp_path / "missing"), [], str(tmp_path)
+    )
+
+    assert output == ""
+    assert "missing" in error
+    assert rc == 1
+
+
+def test_get_executor_per_playbook(monkeypatch):
+    monkeypatch.setattr(executors, "DEFAULT_EXECUTOR", "ansible_runner")
+    monkeypatch.setattr(executors, "PLAYBOOK_EXECUTORS", {"flux": "subprocess"})
+
+    assert executors.get_executor("flux").name == "subprocess"
+    assert executors.get_executor("sshsetup").name == "ansible_runner"
+
+
+def test_check_config_executors():
+    check_config_executors(
+        App(DEFAULT_EXECUTOR="ansible_runner", PLAYBOOK_EXECUTORS={"flux": "subprocess"})
+    )
+    check_config_executors(App(ENV="development", DEFAULT_EXECUTOR="fake"))
+
+    with pytest.raises(ValueError, match="isn't supported"):
+        check_config_executors(
+            App(DEFAULT_EXECUTOR="ansible_runner", PLAYBOOK_EXECUTORS={"flux": "shell"})
+        )
+
+    with pytest.raises(ValueError, match="production"):
+        check_config_executors(
+            App(
+                ENV="production",
+                DEFAULT_EXECUTOR="ansible_runner",
+                PLAYBOOK_EXECUTORS={"flux": "fake"},
+            )
+        )
@@ -0,0 +1,58 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import sqlite3
+
+import pytest
+
+from host_index import host_index
+
+RECAP = """
+PLAY RECAP *********************************************************************
+node1                      : ok=3    changed=1    unreachable=0    failed=0    skipped=2
+node2                      : ok=1    changed=0    unreachable=1    failed=0    skipped=0
+"""
+
+
+@pytest.fixture(autouse=True)
+def reset_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        host_index, "HOST_INDEX_FILE", str(tmp_path / "host_index.sqlite3")
+    )
+    monkeypatch.setattr(host_index, "connection", None)
+    monkeypatch.setattr(host_index, "connection_pid", None)
+
+
+def hosts(results) -> list[tuple[str, str]]:
+    return [(result["host"], result["pattern"]) for result in results]
+
+
+def test_query_filters_by_pattern():
+    host_index.index_results("one", "ipcheck", "group1", "flux", RECAP, 1)
+    host_index.index_results(
+        "two", "sshsetup", "group2", "flux", RECAP.replace("node", "other"), 2
+    )
+
+    assert hosts(host_index.query_results(patterns=["group1"])) == [
+        ("node1", "group1"),
+        ("node2", "group1"),
+    ]
+    assert hosts(host_index.query_results(prefix="other", patterns=None)) == [
+        ("other1", "group2"),
+        ("other2", "group2"),
+    ]
+    assert host_index.query_results(patterns=[]) == []
+    assert hosts(host_index.query_results(status=host_index.HOST_UNREACHABLE)) == [
+        ("node2", "group1"),
+        ("other2", "group2"),
+    ]
+
+
+def test_query_errors_return_none(monkeypatch):
+    def get_connection():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(host_index, "get_connection", get_connection)
+    assert host_index.query_results() is None
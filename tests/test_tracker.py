@@ -0,0 +1,167 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import time
+from threading import Thread
+
+import pytest
+
+from thread_tracker import tracker
+from webhook import webhook
+
+
+@pytest.fixture(autouse=True)
+def reset_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        tracker, "JOB_RECORDS_FILE", str(tmp_path / "job_records.json")
+    )
+    monkeypatch.setattr(tracker, "job_records_mtime", None)
+
+    yield
+
+    tracker.event_tracker.clear()
+    tracker.pattern_tracker.clear()
+    tracker.threads.clear()
+    for event in tracker.scheduler.queue:
+        tracker.scheduler.cancel(event)
+    tracker.draining.clear()
+    tracker.cleanup_done.clear()
+
+
+@pytest.fixture
+def webhooks(monkeypatch):
+    queued = []
+    monkeypatch.setattr(
+        webhook,
+        "queue_webhook",
+        lambda tracker_event_id, command: queued.append(
+            (tracker_event_id, webhook.WEBHOOK_STATUSES.get(command.status))
+        ),
+    )
+    return queued
+
+
+def running_command() -> tracker.Command:
+    command = tracker.Command(
+        pattern="nickname",
+        tag="ipcheck",
+        playbook_name="flux",
+        playbook_path="flux.yml",
+        extra_vars={},
+        callback_url="https://dashboard.example.com/hooks/flux",
+        callback_key_id="key-id",
+    )
+    command.set_status(tracker.STATUS_RUNNING)
+    return command
+
+
+def test_records_are_handed_over_while_draining(monkeypatch):
+    # The old worker saves its running command when it starts draining
+    command = running_command()
+    old_worker = {"running": command}
+    monkeypatch.setattr(tracker, "event_tracker", old_worker)
+    tracker.save_job_records(final=False)
+
+    # The new worker keeps the inventory busy while the old worker runs the command
+    monkeypatch.setattr(tracker, "event_tracker", {})
+    tracker.load_job_records()
+    restored = tracker.event_tracker["running"]
+    assert restored.restored_timestamp
+    assert not restored.tracker_event.is_set()
+    assert tracker.get_pattern_id("nickname").event_id == "running"
+
+    # The command completes and the old worker saves again before it exits
+    new_worker = tracker.event_tracker
+    command.tracker_event.set()
+    command.set_completed_time(time.time())
+    command.set_status(tracker.STATUS_COMPLETED)
+    monkeypatch.setattr(tracker, "event_tracker", old_worker)
+    tracker.save_job_records()
+
+    monkeypatch.setattr(tracker, "event_tracker", new_worker)
+    tracker.load_job_records()
+    restored = tracker.event_tracker["running"]
+    assert restored.status == tracker.STATUS_COMPLETED
+    assert restored.tracker_event.is_set()
+    assert not tracker.is_pattern_running("nickname")
+
+
+def test_new_workers_dont_overwrite_restored_records(monkeypatch):
+    monkeypatch.setattr(tracker, "event_tracker", {"running": running_command()})
+    tracker.save_job_records(final=False)
+
+    monkeypatch.setattr(tracker, "event_tracker", {})
+    tracker.load_job_records()
+    tracker.save_job_records()
+
+    with open(tracker.JOB_RECORDS_FILE) as file:
+        records = tracker.read_job_records(file)
+    assert records["running"]["status"] == tracker.STATUS_RUNNING
+
+
+def test_restored_command_expires_if_never_saved_again(webhooks):
+    command = tracker.record_to_command(
+        tracker.command_to_record(running_command(), final=False)
+    )
+    assert command.callback_url and command.callback_key_id == "key-id"
+    tracker.event_tracker["running"] = command
+
+    tracker.delete_old_trackers()
+    assert not command.tracker_event.is_set()
+    assert webhooks == []
+
+    command.restored_timestamp -= tracker.RESTORED_RUNNING_EXPIRY + 1
+    tracker.delete_old_trackers()
+    assert command.tracker_event.is_set()
+    assert command.status == tracker.STATUS_INTERRUPTED
+    assert webhooks == [("running", "interrupted")]
+
+    # The command is ours now, its final state is saved with our records
+    assert not command.restored_timestamp
+    tracker.delete_old_trackers()
+    assert webhooks == [("running", "interrupted")]
+
+
+def test_cleanup_saves_and_calls_back_unfinished_commands(webhooks):
+    tracker.event_tracker["running"] = running_command()
+    queued = running_command()
+    queued.set_status(tracker.STATUS_QUEUED)
+    tracker.event_tracker["queued"] = queued
+
+    thread = Thread(target=time.sleep, args=[0.5])
+    thread.start()
+    tracker.threads.append(thread)
+
+    heartbeats = []
+    tracker.cleanup(timeout=0.2, heartbeat=lambda: heartbeats.append(time.time()))
+    assert heartbeats
+
+    with open(tracker.JOB_RECORDS_FILE) as file:
+        records = tracker.read_job_records(file)
+    assert records["running"]["status"] == tracker.STATUS_INTERRUPTED
+    assert records["queued"]["status"] == tracker.STATUS_CANCELLED
+    assert sorted(webhooks) == [("queued", "cancelled"), ("running", "interrupted")]
+
+    thread.join()
+
+
+def test_cleanup_saves_records_if_the_heartbeat_fails(webhooks):
+    tracker.event_tracker["running"] = running_command()
+    thread = Thread(target=time.sleep, args=[0.5])
+    thread.start()
+    tracker.threads.append(thread)
+
+    def heartbeat():
+        raise ValueError("I/O operation on closed file")
+
+    with pytest.raises(ValueError):
+        tracker.cleanup(timeout=0.2, heartbeat=heartbeat)
+
+    with open(tracker.JOB_RECORDS_FILE) as file:
+        records = tracker.read_job_records(file)
+    assert records["running"]["status"] == tracker.STATUS_INTERRUPTED
+    assert webhooks == [("running", "interrupted")]
+
+    thread.join()
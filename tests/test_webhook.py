@@ -0,0 +1,134 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+import json
+import os
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from tools.helper import api_key_id
+from webhook import webhook
+
+
+@pytest.fixture(autouse=True)
+def reset_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        webhook, "WEBHOOK_QUEUE_FILE", str(tmp_path / "webhook_queue.json")
+    )
+    monkeypatch.setattr(webhook, "API_KEYS", {"key": {"callback_secret": "secret"}})
+
+    yield
+
+    webhook.delivery_queue.clear()
+    webhook.deliveries_in_flight.clear()
+
+
+def make_delivery(tracker_event_id: str) -> webhook.Delivery:
+    return webhook.Delivery(
+        tracker_event_id=tracker_event_id,
+        url="https://dashboard.example.com/hooks/flux",
+        body="{}",
+        key_id=api_key_id("key"),
+    )
+
+
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_queue(file_name: str, deliveries: list[webhook.Delivery]):
+    with open(file_name, "w") as file:
+        json.dump([asdict(delivery) for delivery in deliveries], file)
+
+
+def queued_ids() -> list[str]:
+    return sorted(delivery.tracker_event_id for _, _, delivery in webhook.delivery_queue)
+
+
+def test_load_claims_only_exited_workers_queues():
+    live_file = webhook.queue_file(os.getppid())
+    exited_file = webhook.queue_file(exited_pid())
+    write_queue(live_file, [make_delivery("live")])
+    write_queue(exited_file, [make_delivery("exited")])
+
+    with webhook.delivery_condition:
+        webhook.load_delivery_queue()
+
+    assert queued_ids() == ["exited"]
+    assert os.path.exists(live_file)
+    assert not os.path.exists(exited_file)
+
+    # The claimed deliveries are now persisted as this worker's
+    with open(webhook.queue_file(os.getpid())) as file:
+        assert [item["tracker_event_id"] for item in json.load(file)] == ["exited"]
+
+    # Claiming again doesn't duplicate them
+    with webhook.delivery_condition:
+        webhook.load_delivery_queue()
+    assert queued_ids() == ["exited"]
+
+
+def test_every_attempt_is_signed(monkeypatch):
+    sent = []
+
+    def post_delivery(delivery, secret):
+        sent.append(secret)
+        return 503
+
+    monkeypatch.setattr(webhook, "post_delivery", post_delivery)
+
+    delivery = make_delivery("retry")
+    assert not webhook.deliver(delivery)
+    assert not webhook.deliver(delivery)
+    assert sent == ["secret", "secret"]
+
+    # The key was removed from the config, the delivery can't be signed any more
+    monkeypatch.setattr(webhook, "API_KEYS", {})
+    assert webhook.deliver(delivery)
+    assert delivery.attempts == 2
+
+
+class Receiver(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Close idle keep-alive connections quickly, like a receiver behind a load balancer
+    timeout = 0.2
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_closed_idle_connection_is_retried_straight_away():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        delivery = make_delivery("keepalive")
+        delivery.url = f"http://127.0.0.1:{server.server_port}/hooks/flux"
+
+        assert webhook.deliver(delivery)
+        time.sleep(0.5)
+
+        # The pooled connection has been closed by the receiver
+        delivery.attempts = 0
+        assert webhook.deliver(delivery)
+        assert delivery.attempts == 1
+    finally:
+        webhook.connection_pool.close()
+        server.shutdown()
+        server.server_close()
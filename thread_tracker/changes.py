@@ -0,0 +1,101 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import itertools
+import os
+import time
+import uuid
+from collections import deque
+from threading import BoundedSemaphore, Condition
+from typing import TYPE_CHECKING
+
+from config.config import (
+    CHANGE_FEED_MAX_WAIT,
+    CHANGE_FEED_MAX_WAITERS,
+    CHANGE_FEED_SIZE,
+)
+
+if TYPE_CHECKING:
+    from thread_tracker.tracker import Command
+
+# Job state transitions recorded in the feed
+CHANGE_QUEUED = "queued"
+CHANGE_STARTED = "started"
+CHANGE_COMPLETED = "completed"
+CHANGE_EXPIRED = "expired"
+
+# Sequence numbers restart with the process, the feed id lets clients notice that and resync.
+# It is created on first use in each process, so forked workers don't share one
+feed_id = None
+feed_id_pid = None
+
+# The most recent changes, oldest first. Older changes fall off the front
+changes: deque[dict] = deque(maxlen=CHANGE_FEED_SIZE)
+latest_sequence = 0
+changes_condition = Condition()
+
+# Each waiting request holds a server thread, so only a few may wait at once
+changes_waiters = BoundedSemaphore(CHANGE_FEED_MAX_WAITERS)
+
+
+def record_change(tracker_event_id: str, state: str, command: Command) -> None:
+    """Add a job state transition to the feed and wake up any long polls"""
+    global latest_sequence
+
+    with changes_condition:
+        latest_sequence += 1
+        changes.append(
+            {
+                "sequence": latest_sequence,
+                "tracker_event_id": tracker_event_id,
+                "state": state,
+                "time": time.time(),
+                "tag": command.tag,
+                "pattern": command.pattern,
+                "playbook": command.playbook_name,
+            }
+        )
+        changes_condition.notify_all()
+
+
+def current_feed_id() -> str:
+    global feed_id, feed_id_pid
+
+    with changes_condition:
+        if feed_id_pid != os.getpid():
+            feed_id = str(uuid.uuid4())
+            feed_id_pid = os.getpid()
+
+        return feed_id
+
+
+def changes_since(sequence: int, wait: float = 0) -> tuple[list[dict], int, bool]:
+    """Get the changes after a sequence number, waiting up to wait seconds for one if
+    there are none yet. Returns (changes, latest sequence, truncated). truncated is True
+    if changes the client hasn't seen already fell out of the feed"""
+    wait = min(max(wait, 0), CHANGE_FEED_MAX_WAIT)
+
+    # When enough requests are already waiting, answer straight away as if wait was 0
+    waiting = bool(wait) and changes_waiters.acquire(blocking=False)
+
+    try:
+        with changes_condition:
+            if waiting and sequence >= latest_sequence:
+                changes_condition.wait_for(lambda: sequence < latest_sequence, wait)
+
+            oldest_sequence = (
+                changes[0]["sequence"] if changes else latest_sequence + 1
+            )
+            truncated = sequence + 1 < oldest_sequence and sequence < latest_sequence
+
+            # Sequence numbers are contiguous, so the first new change can be found by position
+            start = max(0, sequence + 1 - oldest_sequence)
+            response = list(itertools.islice(changes, start, None))
+
+            return response, latest_sequence, truncated
+    finally:
+        if waiting:
+            changes_waiters.release()
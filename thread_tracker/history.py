@@ -0,0 +1,162 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+from dataclasses import dataclass, field
+from threading import Lock
+
+from config.config import DURATION_HISTORY_FILE
+from logger.logs import setup_logger
+
+logger = setup_logger()
+
+# Weight given to the newest duration when updating the moving average
+EWMA_ALPHA = 0.3
+
+# Number of recent durations kept per combination to compute quantiles
+MAX_SAMPLES = 32
+
+# Dictionary of duration statistics keyed by "playbook|tag|pattern"
+duration_history: dict[str, DurationStats] = {}
+duration_history_lock = Lock()
+
+# Modification time of the file when we last loaded it, to notice other workers' changes
+duration_history_mtime = None
+
+
+@dataclass
+class DurationStats:
+    """Compact duration statistics for a playbook/tag/pattern combination"""
+
+    count: int = 0
+    ewma: float = 0
+    samples: list[float] = field(default_factory=list)
+
+    def add(self, duration: float):
+        if self.count == 0:
+            self.ewma = duration
+        else:
+            self.ewma = EWMA_ALPHA * duration + (1 - EWMA_ALPHA) * self.ewma
+
+        self.count += 1
+        self.samples.append(duration)
+        if len(self.samples) > MAX_SAMPLES:
+            del self.samples[0]
+
+    def quantile(self, q: float) -> float:
+        """Nearest-rank quantile of the recent samples"""
+        if not self.samples:
+            return 0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "ewma": round(self.ewma, 3),
+            "p50": round(self.quantile(0.5), 3),
+            "p90": round(self.quantile(0.9), 3),
+            "samples": [round(sample, 3) for sample in self.samples],
+        }
+
+
+def history_key(playbook_name: str, tag: str, pattern: str) -> str:
+    return f"{playbook_name}|{tag}|{pattern}"
+
+
+def read_duration_history(file) -> None:
+    """Replace the statistics with the ones in the open file. Caller must hold
+    duration_history_lock"""
+    file.seek(0)
+    try:
+        data = json.load(file)
+    except ValueError:
+        data = {}
+
+    duration_history.clear()
+    for key, stats in data.items():
+        duration_history[key] = DurationStats(
+            count=stats.get("count", 0),
+            ewma=stats.get("ewma", 0),
+            samples=stats.get("samples", [])[-MAX_SAMPLES:],
+        )
+
+
+def load_duration_history() -> None:
+    """Load the persisted statistics if another worker has changed them since we last
+    loaded them. Caller must hold duration_history_lock"""
+    global duration_history_mtime
+
+    try:
+        mtime = os.stat(DURATION_HISTORY_FILE).st_mtime_ns
+    except OSError:
+        return
+
+    if mtime == duration_history_mtime:
+        return
+
+    try:
+        with open(DURATION_HISTORY_FILE, "r") as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            read_duration_history(file)
+    except OSError as e:
+        logger.info(f"Unable to load duration history: {e}")
+        return
+
+    duration_history_mtime = mtime
+
+
+def record_duration(
+    playbook_name: str, tag: str, pattern: str, duration: float
+) -> None:
+    """Record how long a job took. This function acquires locks"""
+    global duration_history_mtime
+
+    with duration_history_lock:
+        try:
+            # Workers share the file, so read the latest statistics, add ours and
+            # write them back while holding the file lock. Otherwise workers would
+            # overwrite each other's durations
+            with open(DURATION_HISTORY_FILE, "a+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                read_duration_history(file)
+
+                # Record against the exact combination and against the playbook/tag for every
+                # pattern, so patterns that have never run still get a sensible estimate
+                for key in (
+                    history_key(playbook_name, tag, pattern),
+                    history_key(playbook_name, tag, "*"),
+                ):
+                    duration_history.setdefault(key, DurationStats()).add(duration)
+
+                file.seek(0)
+                file.truncate()
+                json.dump(
+                    {key: stats.to_dict() for key, stats in duration_history.items()},
+                    file,
+                )
+                file.flush()
+                duration_history_mtime = os.fstat(file.fileno()).st_mtime_ns
+        except OSError as e:
+            logger.info(f"Unable to save duration history: {e}")
+
+
+def expected_duration(playbook_name: str, tag: str, pattern: str) -> float | None:
+    """Expected duration in seconds, or None if this job has never been seen"""
+    with duration_history_lock:
+        load_duration_history()
+
+        for key in (
+            history_key(playbook_name, tag, pattern),
+            history_key(playbook_name, tag, "*"),
+        ):
+            if stats := duration_history.get(key, None):
+                return stats.ewma
+
+    return None
@@ -4,12 +4,18 @@
 # file LICENSE or https://www.opensource.org/licenses/mit-license.php.
 from __future__ import annotations
 
+import fcntl
+import json
+import os
 import sched
 import time
 from dataclasses import dataclass, field
 from threading import Event, Lock, Thread
+from typing import Callable
 
+from config.config import DRAIN_FILE, DRAIN_TIMEOUT, JOB_RECORDS_FILE
 from logger.logs import setup_logger
+from thread_tracker.changes import CHANGE_EXPIRED, record_change
 
 logger = setup_logger()
 
@@ -22,14 +28,41 @@ event_tracker: dict[str, Command] = {}
 # List for all active threads
 threads = []
 
+# Set once this worker stops accepting new commands
+draining = Event()
+cleanup_done = Event()
+
 # Create a scheduler so we can cleanup our trackers
-scheduler = sched.scheduler(time.time, time.sleep)
+# It waits on the draining event instead of sleeping, so a drain doesn't wait for it to wake up
+scheduler = sched.scheduler(time.time, draining.wait)
 scheduler_thread = None
 
 # Create Locks
 pattern_tracker_lock = Lock()
 event_tracker_lock = Lock()
 
+# Seconds between heartbeats while a stopping worker waits for running commands
+HEARTBEAT_INTERVAL = 1
+
+# Job records expire an hour after the command completed, like the trackers
+JOB_RECORD_EXPIRY = 3600
+
+# A stopping worker saves the final state of its running commands within DRAIN_TIMEOUT.
+# If it hasn't after this long it was killed, and the commands are reported as interrupted
+RESTORED_RUNNING_EXPIRY = DRAIN_TIMEOUT + 60
+
+# Modification time of the job records file when we last loaded it
+job_records_mtime = None
+
+# Command.status values
+STATUS_QUEUED = 0
+STATUS_RUNNING = 1
+STATUS_COMPLETED = 2
+# The api shut down while the command was running
+STATUS_INTERRUPTED = 3
+# The api shut down before the command was started
+STATUS_CANCELLED = 4
+
 
 # ToDo: name this properly
 @dataclass
@@ -54,8 +87,14 @@ class Command:
     playbook_name: str
     playbook_path: str
     extra_vars: dict = field(default_factory={})
+    callback_url: str = ""
+    # Id of the api key whose callback_secret signs the callback, see api_key_id
+    callback_key_id: str = ""
     completed_timestamp: float = 0
+    # When a previous worker generation saved this command, 0 for our own commands
+    restored_timestamp: float = 0
     status: int = 0
+    queued_timestamp: float = field(default_factory=time.time)
     started_timestamp: float = field(default_factory=time.time)
     tracker_event: Event = field(default_factory=Event)
     result: Result = field(default_factory=Result)
@@ -92,6 +131,17 @@ def get_pattern_id(pattern: str) -> EventToTagMap | None:
     return map
 
 
+def reserve_pattern(pattern: str, tracker_event_id: str, tag: str) -> bool:
+    """Claim a pattern for a command. Returns False if another command holds it"""
+    with pattern_tracker_lock:
+        if pattern in pattern_tracker:
+            return False
+
+        pattern_tracker[pattern] = EventToTagMap(tracker_event_id, tag)
+
+    return True
+
+
 def delete_tracker(tracker_event_id: str) -> None:
     """Delete tracker funciton. This function acquires locks"""
     with event_tracker_lock:
@@ -106,19 +156,234 @@ def delete_pattern(pattern: str) -> None:
             del pattern_tracker[pattern]
 
 
+def is_draining() -> bool:
+    """True if this worker is draining, or the deploy has asked every worker to drain"""
+    return draining.is_set() or os.path.exists(DRAIN_FILE)
+
+
+def start_drain() -> None:
+    if not draining.is_set():
+        logger.info("Draining: no longer accepting new commands")
+        draining.set()
+
+
+def command_to_record(command: Command, final: bool) -> dict:
+    """Record of a command. While draining (not final) running commands are saved as
+    running, so the new workers know the inventory is still busy"""
+    current_time = time.time()
+    status = command.status
+    completed_timestamp = command.completed_timestamp
+    if not command.tracker_event.is_set():
+        if command.status != STATUS_RUNNING:
+            # Queued commands are never started once we are draining
+            status = STATUS_CANCELLED
+        elif final:
+            status = STATUS_INTERRUPTED
+
+        # Commands that didn't complete expire as if they completed now
+        if status != STATUS_RUNNING:
+            completed_timestamp = current_time
+
+    return {
+        "pattern": command.pattern,
+        "tag": command.tag,
+        "playbook_name": command.playbook_name,
+        "playbook_path": command.playbook_path,
+        "status": status,
+        "queued_timestamp": command.queued_timestamp,
+        "started_timestamp": command.started_timestamp,
+        "completed_timestamp": completed_timestamp,
+        "saved_timestamp": current_time,
+        "callback_url": command.callback_url,
+        "callback_key_id": command.callback_key_id,
+        "output": command.result.output,
+        "error": command.result.error,
+        "rc": command.result.rc,
+    }
+
+
+def record_to_command(record: dict) -> Command:
+    command = Command(
+        pattern=record["pattern"],
+        tag=record["tag"],
+        playbook_name=record["playbook_name"],
+        playbook_path=record["playbook_path"],
+        extra_vars={},
+        callback_url=record["callback_url"],
+        callback_key_id=record["callback_key_id"],
+        completed_timestamp=record["completed_timestamp"],
+        restored_timestamp=record["saved_timestamp"],
+        status=record["status"],
+        queued_timestamp=record["queued_timestamp"],
+        started_timestamp=record["started_timestamp"],
+        result=Result(record["output"], record["error"], record["rc"]),
+    )
+    # Running commands are still running in a stopping worker, everything else is finished
+    if command.status != STATUS_RUNNING:
+        command.tracker_event.set()
+    return command
+
+
+def is_record_expired(record: dict, current_time: float) -> bool:
+    return (
+        current_time - (record["completed_timestamp"] or record["saved_timestamp"])
+        > JOB_RECORD_EXPIRY
+    )
+
+
+def expire_restored_command(command: Command, current_time: float) -> bool:
+    """Report a restored running command as interrupted if the worker running it never
+    saved its final state. Returns True if it was expired"""
+    if (
+        not command.restored_timestamp
+        or command.tracker_event.is_set()
+        or current_time - command.restored_timestamp <= RESTORED_RUNNING_EXPIRY
+    ):
+        return False
+
+    command.set_status(STATUS_INTERRUPTED)
+    command.set_completed_time(current_time)
+    command.tracker_event.set()
+
+    # Its worker is gone, so the command is ours now and we save its final state
+    command.restored_timestamp = 0
+    return True
+
+
+def notify_unfinished_commands(commands: dict[str, Command]) -> None:
+    """Call back the commands that will never complete, so clients relying on webhooks
+    hear about them"""
+    # Imported here, the webhook module imports this one
+    from webhook.webhook import queue_webhook
+
+    for tracker_event_id, command in commands.items():
+        if command.callback_url:
+            queue_webhook(tracker_event_id, command)
+
+
+def read_job_records(file) -> dict:
+    file.seek(0)
+    try:
+        return json.load(file)
+    except ValueError:
+        return {}
+
+
+def save_job_records(final: bool = True) -> dict[str, dict]:
+    """Merge this worker's commands into the job records file, so the next worker
+    generation can still report on them. Workers share the file, so it is locked.
+    Returns the records that were saved"""
+    current_time = time.time()
+
+    # Restored commands are owned by the worker that saved them, it may have newer records
+    with event_tracker_lock:
+        records = {
+            tracker_event_id: command_to_record(command, final)
+            for tracker_event_id, command in event_tracker.items()
+            if not command.restored_timestamp
+        }
+
+    try:
+        with open(JOB_RECORDS_FILE, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            existing = read_job_records(file)
+            existing.update(records)
+
+            # Drop records that would have been deleted by delete_old_trackers
+            existing = {
+                tracker_event_id: record
+                for tracker_event_id, record in existing.items()
+                if not is_record_expired(record, current_time)
+            }
+
+            file.seek(0)
+            file.truncate()
+            json.dump(existing, file)
+    except OSError as e:
+        logger.info(f"Unable to save job records: {e}")
+        return records
+
+    logger.info(f"Saved {len(records)} job records")
+    return records
+
+
+def load_job_records() -> None:
+    """Load job records saved by stopping workers. They keep saving while they drain,
+    so this is called again to pick up the changes. This function acquires locks"""
+    global job_records_mtime
+
+    try:
+        mtime = os.stat(JOB_RECORDS_FILE).st_mtime_ns
+    except OSError:
+        return
+
+    if mtime == job_records_mtime:
+        return
+
+    try:
+        with open(JOB_RECORDS_FILE, "r") as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            records = read_job_records(file)
+    except OSError as e:
+        logger.info(f"Unable to load job records: {e}")
+        return
+
+    job_records_mtime = mtime
+    current_time = time.time()
+    loaded = 0
+    expired = {}
+
+    with event_tracker_lock, pattern_tracker_lock:
+        for tracker_event_id, record in records.items():
+            # Our own commands are always newer than their records
+            existing = event_tracker.get(tracker_event_id, None)
+            if existing and not existing.restored_timestamp:
+                continue
+
+            command = record_to_command(record)
+            if expire_restored_command(command, current_time):
+                expired[tracker_event_id] = command
+            event_tracker[tracker_event_id] = command
+            loaded += 1
+
+            # Keep new commands off an inventory the stopping worker is still running on,
+            # and release it as soon as that command has finished
+            map = pattern_tracker.get(command.pattern, None)
+            if not command.tracker_event.is_set():
+                if not map:
+                    pattern_tracker[command.pattern] = EventToTagMap(
+                        tracker_event_id, command.tag
+                    )
+            elif map and map.event_id == tracker_event_id:
+                del pattern_tracker[command.pattern]
+
+    if loaded:
+        logger.info(f"Loaded {loaded} job records")
+
+    notify_unfinished_commands(expired)
+
+
 def delete_old_trackers() -> None:
+    # Pick up records saved by workers that are still draining
+    load_job_records()
+
     current_time = time.time()
     trackers_to_delete = []
     patterns_to_delete = []
+    expired = {}
 
     # Lock the dictionaries
     with event_tracker_lock, pattern_tracker_lock:
+        for tracker_event_id, command in event_tracker.items():
+            if expire_restored_command(command, current_time):
+                expired[tracker_event_id] = command
+
         # Loop through all trackers and if the event has been set, it means it has been completed
         # If it has been 1 hour and it has been completed queue it for deletion
         for tracker_event_id, command in event_tracker.items():
             if (
                 command.tracker_event.is_set()
-                and (current_time - command.completed_timestamp) > 3600
+                and (current_time - command.completed_timestamp) > JOB_RECORD_EXPIRY
             ):
                 trackers_to_delete.append(tracker_event_id)
 
@@ -133,14 +398,20 @@ def delete_old_trackers() -> None:
 
         # Delete the trackers that have been queued
         for tracker_event_id in trackers_to_delete:
+            record_change(
+                tracker_event_id, CHANGE_EXPIRED, event_tracker[tracker_event_id]
+            )
             del event_tracker[tracker_event_id]
 
         # Delete the patterns that have been queued
         for pattern in patterns_to_delete:
             del pattern_tracker[pattern]
 
-    # Reschedule the task to run again every 5 seconds
-    scheduler.enter(10, 1, delete_old_trackers)
+    notify_unfinished_commands(expired)
+
+    # Reschedule the task to run again every 10 seconds, unless we are shutting down
+    if not draining.is_set():
+        scheduler.enter(10, 1, delete_old_trackers)
 
 
 def schedule_task() -> None:
@@ -149,21 +420,71 @@ def schedule_task() -> None:
 
 
 def schedule_start() -> None:
+    global scheduler_thread
+
     logger.info("Starting Scheduler")
     scheduler_thread = Thread(target=schedule_task)
     scheduler_thread.daemon = True
     scheduler_thread.start()
 
 
-def cleanup() -> None:
-    # Cancel all pending events in the scheduler
-    for event in scheduler.queue:
-        scheduler.cancel(event)
+def cleanup(
+    timeout: float = DRAIN_TIMEOUT, heartbeat: Callable[[], None] | None = None
+) -> None:
+    """Drain: stop accepting commands, give running commands until the timeout to
+    complete, then save the job records for the next worker generation.
+    heartbeat is called while waiting, so the server knows the worker hasn't hung"""
+    if cleanup_done.is_set():
+        return
+    cleanup_done.set()
 
-    # Wait for all threads to finish before exiting
-    for thread in threads:
-        thread.join()
+    start_drain()
+    deadline = time.time() + timeout
 
-    # Wait for the scheduler thread to finish
-    if scheduler_thread:
-        scheduler_thread.join()
+    # Cancel all pending events in the scheduler
+    for event in scheduler.queue:
+        try:
+            scheduler.cancel(event)
+        except ValueError:
+            # The event ran while we were cancelling
+            pass
+
+    # Save the records straight away, so the new workers can report on our commands
+    # and keep our running inventories busy while we wait for them
+    save_job_records(final=False)
+
+    # Always save the final records, even if waiting fails
+    try:
+        # Wait for all threads to finish, up to the deadline
+        for thread in threads:
+            while thread.is_alive() and (remaining := deadline - time.time()) > 0:
+                thread.join(min(remaining, HEARTBEAT_INTERVAL))
+                if heartbeat:
+                    heartbeat()
+
+        running = sum(thread.is_alive() for thread in threads)
+        if running:
+            logger.info(f"Drain timeout reached with {running} commands still running")
+
+        # Wait for the scheduler thread to finish
+        if scheduler_thread:
+            scheduler_thread.join(max(0, deadline - time.time()))
+    finally:
+        with event_tracker_lock:
+            unfinished = {
+                tracker_event_id
+                for tracker_event_id, command in event_tracker.items()
+                if not command.tracker_event.is_set()
+            }
+
+        records = save_job_records()
+
+        # They are saved as interrupted or cancelled and won't complete anywhere,
+        # so call them back now
+        notify_unfinished_commands(
+            {
+                tracker_event_id: record_to_command(record)
+                for tracker_event_id, record in records.items()
+                if tracker_event_id in unfinished
+            }
+        )
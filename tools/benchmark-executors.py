@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+# Compares the per job overhead of the executor backends
+# Run from the repository root: python3 tools/benchmark-executors.py --jobs 20
+# By default it runs a command that exits straight away, so the numbers are the backend overhead
+
+import argparse
+import contextlib
+import io
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from playbook.executors import EXECUTORS  # noqa: E402
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark(executor, command: list[str], jobs: int) -> dict:
+    latencies = []
+    parent_cpu_start = time.process_time()
+    children_cpu_start = children_cpu()
+
+    for _ in range(jobs):
+        started = time.perf_counter()
+        # Executors echo the command output, keep it out of the results
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            executor.run(command[0], command[1:], os.getcwd())
+        latencies.append(time.perf_counter() - started)
+
+    latencies.sort()
+    return {
+        "mean_ms": sum(latencies) / jobs * 1000,
+        "p50_ms": latencies[jobs // 2] * 1000,
+        "p90_ms": latencies[min(jobs - 1, int(jobs * 0.9))] * 1000,
+        "parent_cpu_ms": (time.process_time() - parent_cpu_start) / jobs * 1000,
+        "child_cpu_ms": (children_cpu() - children_cpu_start) / jobs * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the executor backends")
+    parser.add_argument("--jobs", type=int, default=20, help="jobs per executor")
+    parser.add_argument(
+        "--executors",
+        default=",".join(EXECUTORS),
+        help="comma separated executors to benchmark",
+    )
+    parser.add_argument(
+        "command",
+        nargs="*",
+        default=[sys.executable, "-c", "pass"],
+        help="command to run for each job",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'executor':<16}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'cpu ms/job':>12}{'child cpu ms/job':>18}"
+    )
+    for name in args.executors.split(","):
+        try:
+            result = benchmark(EXECUTORS[name], args.command, args.jobs)
+        except ImportError as e:
+            print(f"{name:<16}skipped: {e}")
+            continue
+
+        print(
+            f"{name:<16}{result['mean_ms']:>10.2f}{result['p50_ms']:>10.2f}{result['p90_ms']:>10.2f}"
+            f"{result['parent_cpu_ms']:>12.2f}{result['child_cpu_ms']:>18.2f}"
+        )
@@ -0,0 +1,134 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+
+# Measures worker boot latency, so changes to startup cost can be tracked
+# Run from the repository root with a valid config/config.py: python3 tools/benchmark-startup.py
+#
+# cold    - a fresh interpreter imports the app and starts the background services,
+#           like a gunicorn worker without --preload
+# preload - the app is imported once, then each worker is forked from it and only
+#           starts the background services, like a gunicorn worker with --preload
+#
+# The files the background services read and write are moved to a temporary directory,
+# so the benchmark workers never claim, deliver or rewrite the live webhook queue and records
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Config settings pointing at files the background services use
+SANDBOXED_FILES = [
+    "JOB_RECORDS_FILE",
+    "WEBHOOK_QUEUE_FILE",
+    "DURATION_HISTORY_FILE",
+    "HOST_INDEX_FILE",
+    "DRAIN_FILE",
+]
+
+# Runs before the app is imported, the modules read the settings when they are imported
+SANDBOX_CONFIG = """
+import os
+import config.config
+for name in {names!r}:
+    file_name = os.path.basename(getattr(config.config, name))
+    setattr(config.config, name, os.path.join({directory!r}, file_name))
+"""
+
+COLD_WORKER = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.start_background_services()
+print(imported - started, time.perf_counter() - imported, flush=True)
+
+# Skip the shutdown hooks, only the boot is being measured
+import os
+os._exit(0)
+"""
+
+
+def summary(name: str, samples: list[float]):
+    samples = sorted(samples)
+    mean = sum(samples) / len(samples) * 1000
+    p50 = samples[len(samples) // 2] * 1000
+    p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))] * 1000
+    print(f"{name:<24}{mean:>10.2f}{p50:>10.2f}{p90:>10.2f}")
+
+
+def sandbox_config(directory: str) -> str:
+    return SANDBOX_CONFIG.format(names=SANDBOXED_FILES, directory=directory)
+
+
+def benchmark_cold(runs: int, directory: str):
+    imports = []
+    services = []
+    totals = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", sandbox_config(directory) + COLD_WORKER],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        totals.append(time.perf_counter() - started)
+
+        import_time, services_time = output.split()
+        imports.append(float(import_time))
+        services.append(float(services_time))
+
+    summary("cold import + create_app", imports)
+    summary("cold start services", services)
+    summary("cold total (with python)", totals)
+
+
+def benchmark_preload(runs: int, directory: str):
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    exec(sandbox_config(directory), {})
+
+    started = time.perf_counter()
+    import app
+
+    summary("preload import (once)", [time.perf_counter() - started])
+
+    boots = []
+    for _ in range(runs):
+        read_fd, write_fd = os.pipe()
+        started = time.perf_counter()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            app.start_background_services()
+            os.write(write_fd, b"1")
+            os._exit(0)
+
+        os.close(write_fd)
+        os.read(read_fd, 1)
+        boots.append(time.perf_counter() - started)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+
+    summary("preload worker boot", boots)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark worker startup time")
+    parser.add_argument("--runs", type=int, default=10, help="workers to start")
+    args = parser.parse_args()
+
+    print(f"{'':<24}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}")
+    with tempfile.TemporaryDirectory(prefix="benchmark-startup-") as directory:
+        benchmark_cold(args.runs, directory)
+        benchmark_preload(args.runs, directory)
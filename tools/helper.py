@@ -1,4 +1,7 @@
+from __future__ import annotations
+
 import datetime
+import hashlib
 import os
 
 
@@ -6,6 +9,17 @@ def timestamp_to_datestring(timestamp) -> datetime.datetime:
     return datetime.datetime.fromtimestamp(timestamp).strftime("%c")
 
 
+def optional_datestring(timestamp) -> str | None:
+    if timestamp is None:
+        return None
+    return timestamp_to_datestring(timestamp)
+
+
+# Identify an api key without storing the key itself, e.g. in files written to disk
+def api_key_id(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
 # Check the ENV is set to production when running with gunicorn
 def check_config_gunicorn_production(app):
     if "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
@@ -36,6 +50,12 @@ def check_config_api_keys(app):
                 f"ApiKey: {key} -> 'whitelisted_patterns' configuration variable must be set. Please look at the config/config-example.py"
             )
 
+        # Webhooks are always signed, so a key that can use them needs a secret
+        if info.get("whitelisted_callback_urls") and not info.get("callback_secret"):
+            raise ValueError(
+                f"ApiKey: {key} -> 'callback_secret' configuration variable must be set when 'whitelisted_callback_urls' is set. Please look at the config/config-example.py"
+            )
+
 
 # Check config file directories set, exist, and aren't empty
 def check_config_directories(app):
@@ -54,7 +74,48 @@ def check_config_directories(app):
             raise ValueError(f"{name} directory path doesn't exist")
 
 
+# Check the configured executors exist
+def check_config_executors(app):
+    from playbook.executors import EXECUTORS
+
+    executors = [app.config.get("DEFAULT_EXECUTOR")]
+    executors.extend(app.config.get("PLAYBOOK_EXECUTORS", {}).values())
+
+    for name in executors:
+        if name not in EXECUTORS:
+            raise ValueError(
+                f"Executor: {name} isn't supported. Supported executors: {', '.join(EXECUTORS)}"
+            )
+
+        # The fake executor reports every command as successful without running it
+        if name == "fake" and app.config.get("ENV") == "production":
+            raise ValueError(
+                "Executor: fake can't be used when ENV is set to 'production'"
+            )
+
+
+# Check the adaptive concurrency limit has a range to work in
+def check_config_concurrency(app):
+    if not app.config.get("ADAPTIVE_CONCURRENCY"):
+        return
+
+    max_running = app.config.get("MAX_RUNNING_PLAYBOOKS", 0)
+    min_running = app.config.get("ADAPTIVE_MIN_PLAYBOOKS", 0)
+
+    if max_running <= 0:
+        raise ValueError(
+            "MAX_RUNNING_PLAYBOOKS configuration variable must be above 0 when ADAPTIVE_CONCURRENCY is enabled"
+        )
+
+    if min_running < 1 or min_running > max_running:
+        raise ValueError(
+            "ADAPTIVE_MIN_PLAYBOOKS configuration variable must be between 1 and MAX_RUNNING_PLAYBOOKS"
+        )
+
+
 def verify_config(app):
     check_config_gunicorn_production(app)
     check_config_api_keys(app)
     check_config_directories(app)
+    check_config_executors(app)
+    check_config_concurrency(app)
@@ -0,0 +1,426 @@
+# Copyright (c) 2024 Jeremy Anderson
+# Copyright (c) 2024 Influx Technologies Limited
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or https://www.opensource.org/licenses/mit-license.php.
+from __future__ import annotations
+
+import hashlib
+import heapq
+import hmac
+import http.client
+import fcntl
+import glob
+import itertools
+import json
+import os
+import random
+import time
+from dataclasses import asdict, dataclass
+from threading import Condition, Lock, Thread
+from urllib.parse import urlsplit
+
+from config.config import (
+    API_KEYS,
+    WEBHOOK_MAX_ATTEMPTS,
+    WEBHOOK_QUEUE_FILE,
+    WEBHOOK_RETRY_BASE,
+    WEBHOOK_RETRY_MAX,
+    WEBHOOK_TIMEOUT,
+    WEBHOOK_WORKERS,
+)
+from logger.logs import setup_logger
+from thread_tracker.tracker import STATUS_CANCELLED, STATUS_INTERRUPTED, Command
+from tools.helper import api_key_id, timestamp_to_datestring
+
+logger = setup_logger()
+
+# Idle keep-alive connections kept open per host
+MAX_IDLE_CONNECTIONS = 4
+
+# Status codes that are worth retrying, other 4xx responses won't succeed on retry
+RETRY_STATUS_CODES = {408, 429}
+
+# Errors from an idle connection the receiver has closed in the meantime
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+# Status sent for commands the api was restarted before they could complete
+WEBHOOK_STATUSES = {STATUS_INTERRUPTED: "interrupted", STATUS_CANCELLED: "cancelled"}
+
+# How often each worker looks for deliveries left behind by workers that have exited
+CLAIM_INTERVAL = 60
+
+
+@dataclass
+class Delivery:
+    """A webhook waiting to be delivered. It is signed when each attempt is sent"""
+
+    tracker_event_id: str
+    url: str
+    body: str
+    key_id: str
+    attempts: int = 0
+    next_attempt: float = 0
+
+
+# Deliveries waiting to be sent, as a heap of (next_attempt, sequence, delivery)
+delivery_queue: list[tuple[float, int, Delivery]] = []
+
+# Deliveries a worker is currently sending, so they are still persisted
+deliveries_in_flight: dict[int, Delivery] = {}
+
+delivery_condition = Condition()
+delivery_sequence = itertools.count()
+delivery_workers: list[Thread] = []
+delivery_stopping = False
+next_claim = 0
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections per host so deliveries can reuse them"""
+
+    def __init__(self, max_idle: int):
+        self.max_idle = max_idle
+        self.idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self.lock = Lock()
+
+    def get(
+        self, scheme: str, netloc: str
+    ) -> tuple[http.client.HTTPConnection, bool]:
+        """Get a connection, and whether it is an idle one being reused"""
+        with self.lock:
+            connections = self.idle.get((scheme, netloc), [])
+            if connections:
+                return connections.pop(), True
+
+        return self.connect(scheme, netloc), False
+
+    def connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=WEBHOOK_TIMEOUT)
+        return http.client.HTTPConnection(netloc, timeout=WEBHOOK_TIMEOUT)
+
+    def put(self, scheme: str, netloc: str, connection: http.client.HTTPConnection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+connection_pool = ConnectionPool(MAX_IDLE_CONNECTIONS)
+
+
+def sign_payload(secret: str, timestamp: str, body: str) -> str:
+    """HMAC-SHA256 of "timestamp.body", receivers should recompute and compare it"""
+    message = f"{timestamp}.{body}".encode()
+    return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def callback_secret(key_id: str) -> str | None:
+    """Secret of the api key with this id, or None if the key has been removed"""
+    for api_key, api_key_dict in API_KEYS.items():
+        if api_key_id(api_key) == key_id:
+            return api_key_dict.get("callback_secret")
+
+    return None
+
+
+def queue_file(pid: int) -> str:
+    """Every worker persists its own deliveries, so workers never overwrite each other"""
+    return f"{WEBHOOK_QUEUE_FILE}.{pid}"
+
+
+def save_delivery_queue() -> None:
+    """Persist pending deliveries. Caller must hold delivery_condition"""
+    data = [asdict(delivery) for _, _, delivery in delivery_queue]
+    data.extend(asdict(delivery) for delivery in deliveries_in_flight.values())
+    file_name = queue_file(os.getpid())
+    temp_file = f"{file_name}.tmp"
+
+    try:
+        with open(temp_file, "w") as file:
+            json.dump(data, file)
+        os.replace(temp_file, file_name)
+    except OSError as e:
+        logger.info(f"Unable to save webhook queue: {e}")
+
+
+def is_process_running(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The pid has been reused by a process we can't signal
+        return True
+
+    return True
+
+
+def orphaned_queue_files() -> list[str]:
+    """Queue files of workers that have exited"""
+    orphaned = []
+
+    for file_name in glob.glob(f"{glob.escape(WEBHOOK_QUEUE_FILE)}.*"):
+        pid = file_name[len(WEBHOOK_QUEUE_FILE) + 1 :]
+        if pid.isdigit() and not is_process_running(int(pid)):
+            orphaned.append(file_name)
+
+    return orphaned
+
+
+def read_deliveries(file_name: str) -> list[Delivery]:
+    try:
+        with open(file_name, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.info(f"Unable to load webhook queue: {file_name}, {e}")
+        return []
+
+    return [Delivery(**item) for item in data]
+
+
+def load_delivery_queue() -> None:
+    """Claim the deliveries left behind by workers that have exited. Caller must hold
+    delivery_condition"""
+    try:
+        # Only one worker may claim a file, otherwise the deliveries would be sent twice
+        with open(f"{WEBHOOK_QUEUE_FILE}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            claimed = orphaned_queue_files()
+            if not claimed:
+                return
+
+            count = 0
+            for file_name in claimed:
+                for delivery in read_deliveries(file_name):
+                    heapq.heappush(
+                        delivery_queue,
+                        (delivery.next_attempt, next(delivery_sequence), delivery),
+                    )
+                    count += 1
+
+            # Persist the deliveries as ours before removing the files they came from
+            save_delivery_queue()
+            for file_name in claimed:
+                os.remove(file_name)
+    except OSError as e:
+        logger.info(f"Unable to claim webhook queues: {e}")
+        return
+
+    logger.info(f"Loaded {count} pending webhooks")
+    delivery_condition.notify_all()
+
+
+def queue_webhook(tracker_event_id: str, command: Command) -> None:
+    """Queue the result summary of a finished command for delivery to its callback url"""
+    body = json.dumps(
+        {
+            "tracker_event_id": tracker_event_id,
+            "status": WEBHOOK_STATUSES.get(command.status, "completed"),
+            "tag": command.tag,
+            "pattern": command.pattern,
+            "playbook": command.playbook_name,
+            "ansible_started_time": timestamp_to_datestring(
+                command.started_timestamp
+            ),
+            "ansible_completed_time": timestamp_to_datestring(
+                command.completed_timestamp
+            ),
+            "ansible_return_code": command.result.rc,
+        }
+    )
+    delivery = Delivery(
+        tracker_event_id=tracker_event_id,
+        url=command.callback_url,
+        body=body,
+        key_id=command.callback_key_id,
+    )
+
+    with delivery_condition:
+        heapq.heappush(delivery_queue, (0, next(delivery_sequence), delivery))
+        save_delivery_queue()
+        delivery_condition.notify()
+
+
+def send_request(
+    connection: http.client.HTTPConnection, path: str, body: str, headers: dict
+) -> http.client.HTTPResponse:
+    connection.request("POST", path, body=body, headers=headers)
+    response = connection.getresponse()
+    # The body must be read before the connection can be reused
+    response.read()
+    return response
+
+
+def post_delivery(delivery: Delivery, secret: str) -> int:
+    """POST the delivery, returning the response status code"""
+    # Sign every attempt, so retries don't carry a stale timestamp
+    timestamp = str(int(time.time()))
+    signature = sign_payload(secret, timestamp, delivery.body)
+
+    url = urlsplit(delivery.url)
+    path = url.path or "/"
+    if url.query:
+        path = f"{path}?{url.query}"
+
+    headers = {
+        "Content-Type": "application/json",
+        "Connection": "keep-alive",
+        "X-Flux-Timestamp": timestamp,
+        "X-Flux-Signature": signature,
+    }
+
+    connection, reused = connection_pool.get(url.scheme, url.netloc)
+    try:
+        response = send_request(connection, path, delivery.body, headers)
+    except STALE_CONNECTION_ERRORS:
+        connection.close()
+        if not reused:
+            raise
+
+        # Receivers close idle keep-alive connections, so a reused one failing before
+        # the response doesn't count as an attempt. Try once more on a new connection
+        connection = connection_pool.connect(url.scheme, url.netloc)
+        try:
+            response = send_request(connection, path, delivery.body, headers)
+        except Exception:
+            connection.close()
+            raise
+    except Exception:
+        connection.close()
+        raise
+
+    if response.will_close:
+        connection.close()
+    else:
+        connection_pool.put(url.scheme, url.netloc, connection)
+
+    return response.status
+
+
+def deliver(delivery: Delivery) -> bool:
+    """Try to deliver once. Returns True if the delivery is finished, delivered or not"""
+    secret = callback_secret(delivery.key_id)
+    if not secret:
+        logger.info(
+            f"Webhook dropped, api key no longer has a callback secret: ID: {delivery.tracker_event_id}"
+        )
+        return True
+
+    delivery.attempts += 1
+
+    try:
+        status = post_delivery(delivery, secret)
+    except Exception as e:
+        logger.info(
+            f"Webhook failed: ID: {delivery.tracker_event_id}, Attempt: {delivery.attempts}, Error: {e}"
+        )
+    else:
+        if 200 <= status < 300:
+            logger.info(f"Webhook delivered: ID: {delivery.tracker_event_id}")
+            return True
+
+        logger.info(
+            f"Webhook failed: ID: {delivery.tracker_event_id}, Attempt: {delivery.attempts}, Status: {status}"
+        )
+        if 400 <= status < 500 and status not in RETRY_STATUS_CODES:
+            return True
+
+    if delivery.attempts >= WEBHOOK_MAX_ATTEMPTS:
+        logger.info(f"Webhook dropped after retries: ID: {delivery.tracker_event_id}")
+        return True
+
+    # Exponential backoff with jitter, so a receiver coming back up isn't hit all at once
+    delay = min(WEBHOOK_RETRY_MAX, WEBHOOK_RETRY_BASE * 2 ** (delivery.attempts - 1))
+    delivery.next_attempt = time.time() + delay * random.uniform(0.5, 1)
+    return False
+
+
+def delivery_worker() -> None:
+    global next_claim
+
+    while True:
+        with delivery_condition:
+            while True:
+                if delivery_stopping:
+                    return
+
+                now = time.time()
+
+                # Workers of the previous generation may exit after we started
+                if now >= next_claim:
+                    next_claim = now + CLAIM_INTERVAL
+                    load_delivery_queue()
+                    continue
+
+                if delivery_queue and delivery_queue[0][0] <= now:
+                    _, sequence, delivery = heapq.heappop(delivery_queue)
+                    deliveries_in_flight[sequence] = delivery
+                    break
+
+                # Sleep until the next retry is due, or until a new delivery is queued
+                timeout = next_claim - now
+                if delivery_queue:
+                    timeout = min(timeout, delivery_queue[0][0] - now)
+                delivery_condition.wait(timeout)
+
+        finished = deliver(delivery)
+
+        with delivery_condition:
+            del deliveries_in_flight[sequence]
+            if not finished:
+                heapq.heappush(
+                    delivery_queue, (delivery.next_attempt, sequence, delivery)
+                )
+                delivery_condition.notify()
+            save_delivery_queue()
+
+
+def start_webhook_workers() -> None:
+    global delivery_stopping, next_claim
+
+    logger.info("Starting Webhook Workers")
+
+    with delivery_condition:
+        delivery_stopping = False
+        next_claim = time.time() + CLAIM_INTERVAL
+        load_delivery_queue()
+
+    for _ in range(WEBHOOK_WORKERS):
+        thread = Thread(target=delivery_worker)
+        thread.daemon = True
+        thread.start()
+        delivery_workers.append(thread)
+
+
+def stop_webhook_workers() -> None:
+    """Stop the workers. Pending deliveries stay persisted for the next start"""
+    global delivery_stopping
+
+    with delivery_condition:
+        delivery_stopping = True
+        delivery_condition.notify_all()
+
+    for thread in delivery_workers:
+        thread.join(WEBHOOK_TIMEOUT)
+    delivery_workers.clear()
+
+    connection_pool.close()